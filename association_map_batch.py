@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Headless conversion of many Association Map workbooks against one Relationshipmap
+# Features template, spread over a process pool.
+#
+#   python association_map_batch.py maps/ --output-dir out/ --workers 8
+#   python association_map_batch.py manifest.csv --sqlite maps.db --report report.json
+#
+# A manifest is a CSV with a 'path' column and an optional 'project' column; relative
+# paths are resolved against the manifest's directory. Without a project the file name
+# is used.
+#
+# With --shard-by, each map is written as a directory of shard files and a manifest (see
+# association_map_shards) and saved as one row per file, named <project>/<file>.
+#
+# With --stream-connections, the Connections sheet is read and converted in chunks under
+# a memory ceiling (see association_map_stream) and each map is written straight to
+# --output-dir, for workbooks too large to load whole.
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from association_map_delta import regenerate
+from association_map_shards import PARTITIONS, shard_map
+from association_map_stream import stream_json
+from association_map_utils import (EXPORT_ENCODINGS, SHAPE_IMAGES, ExcelReader, JsonStreamEncoder, SheetDiskCache, StyleTables,
+                                   WorkbookCache, WorkbookLoader, encode_export, export_encodings, generate_json)
+from association_map_validation import MODES, READ_COLUMNS, READ_DTYPES, validate_workbooks
+
+DEFAULT_TEMPLATE = 'Relationshipmap Features Template.xlsx'
+
+_template = None
+_styles = None
+_workbooks = None
+_reader = ExcelReader(sheet_columns=READ_COLUMNS, dtypes=READ_DTYPES)
+
+
+def init_worker(template_path, cache_dir=None):
+    # each worker parses the shared template and compiles its style tables once; with
+    # cache_dir, parsed sheets are shared through the on-disk Arrow cache with other
+    # workers and later runs
+    global _template, _styles, _workbooks
+    disk_cache = None if cache_dir is None else SheetDiskCache(cache_dir, namespace=_reader.signature())
+    _workbooks = WorkbookCache(maxsize=1, loader=WorkbookLoader(workers=1, reader=_reader), disk_cache=disk_cache)
+    _template = _workbooks.get(template_path)
+    _styles = StyleTables.compile(_template.sheets, _template.digest)
+
+
+def convert(path, project, mode, shapes, output_dir, compact, keep_bytes, shard_by=None, max_shard_nodes=10000, index=False,
+            format_version=1, encodings=('json',), json_backend='json'):
+    result = {'file': path, 'project': project, 'status': 'ok', 'error': None, 'timings': {}}
+    timings = result['timings']
+    try:
+        start = time.perf_counter()
+        bundle_AM = _workbooks.get(path)
+        timings['parse'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        report = validate_workbooks(bundle_AM.sheets, _template.sheets, mode)
+        timings['validate'] = time.perf_counter() - start
+        if not report.is_valid():
+            result['status'] = 'invalid'
+            result['error'] = describe_violations(report)
+            return result
+
+        start = time.perf_counter()
+        distinct_values = bundle_AM['Node']['SubType'].unique().tolist()
+        d = {}
+        if mode == 'Fill from UI':
+            d = {subtype: shapes[subtype] for subtype in distinct_values}
+        encoder = JsonStreamEncoder(compact=compact, backend=json_backend)
+        if shard_by is None:
+            json_bytes = generate_json(bundle_AM, _template, mode, d, SHAPE_IMAGES, distinct_values, encoder, index=index, styles=_styles,
+                                       format_version=format_version)
+            rows = [(json_bytes, project)]
+        else:
+            revision = regenerate(bundle_AM, _template, mode, d, SHAPE_IMAGES, distinct_values, encoder=encoder, index=index,
+                                  styles=_styles).revision
+            sharded = shard_map(revision.header, revision.node_list(), revision.edges, bundle_AM['Node'], shard_by,
+                                max_shard_nodes, encoder)
+            rows = sharded.rows(project)
+            result['shards'] = len(sharded.manifest['shards'])
+        timings['generate'] = time.perf_counter() - start
+        result['nodes'] = len(bundle_AM['Node'])
+        result['connections'] = len(bundle_AM['Connections'])
+        result['bytes'] = sum(len(data) for data, name in rows)
+
+        if output_dir is not None:
+            start = time.perf_counter()
+            output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0])
+            if shard_by is None:
+                # every encoding is written next to the others; 'json' is the bytes as generated
+                result['encodings'] = {}
+                for name in encodings:
+                    data, stats = (json_bytes, {'encoding': name, 'bytes': len(json_bytes)}) if name == 'json' else encode_export(name, json_bytes)
+                    with open(output_path + EXPORT_ENCODINGS[name].extension, 'wb') as f:
+                        f.write(data)
+                    result['encodings'][name] = stats
+                output_path += EXPORT_ENCODINGS[encodings[0]].extension
+            else:
+                output_path += '.shards'
+                sharded.write(output_path)
+            result['output'] = output_path
+            timings['write'] = time.perf_counter() - start
+        if keep_bytes:
+            result['json_rows'] = rows
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def convert_stream(path, project, mode, shapes, output_dir, compact, chunk_rows=50000, max_memory=256 * 1024 * 1024,
+                   json_backend='json'):
+    # convert() for --stream-connections: the map is written to output_dir as it is
+    # generated, through a temporary file so an interrupted run leaves no partial map
+    result = {'file': path, 'project': project, 'status': 'ok', 'error': None, 'timings': {}}
+    output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + '.json')
+    tmp_path = output_path + '.tmp'
+    try:
+        start = time.perf_counter()
+        with open(tmp_path, 'wb') as f:
+            report = stream_json(path, _template, mode, shapes, SHAPE_IMAGES, f, JsonStreamEncoder(compact=compact, backend=json_backend),
+                                 chunk_rows, max_memory, _styles, temp_dir=output_dir)
+        result['timings']['generate'] = time.perf_counter() - start
+        if not report.is_valid():
+            os.unlink(tmp_path)
+            result['status'] = 'invalid'
+            result['error'] = describe_violations(report)
+            return result
+        os.replace(tmp_path, output_path)
+        result['output'] = output_path
+        result['bytes'] = os.path.getsize(output_path)
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        result['status'] = 'error'
+        result['error'] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def describe_violations(report):
+    return '; '.join(f"{v['message']} (sheet '{v['sheet']}', rows {v['rows'][:10]})" if v['rows'] else v['message']
+                     for v in report.violations)
+
+
+def read_inputs(source):
+    # (path, project) pairs from a directory of workbooks or a CSV manifest
+    if os.path.isdir(source):
+        names = sorted(name for name in os.listdir(source) if name.endswith(('.xlsx', '.xls')) and not name.startswith('~$'))
+        return [(os.path.join(source, name), os.path.splitext(name)[0]) for name in names]
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, newline='') as f:
+        rows = list(csv.DictReader(f))
+    inputs = []
+    for row in rows:
+        path = row['path'] if os.path.isabs(row['path']) else os.path.join(base, row['path'])
+        inputs.append((path, row.get('project') or os.path.splitext(os.path.basename(path))[0]))
+    return inputs
+
+
+def open_store(args):
+    from association_map_db import JsonStore
+    if args.sqlite:
+        return JsonStore.sqlite(args.sqlite)
+    return JsonStore.postgres({'dsn': args.postgres})
+
+
+def run_batch(inputs, template_path=DEFAULT_TEMPLATE, mode='Default', shapes=None, output_dir=None, store=None,
+              workers=None, compact=False, cache_dir=None, shard_by=None, max_shard_nodes=10000, index=False, format_version=1,
+              encodings=('json',), stream=False, chunk_rows=50000, max_memory=256 * 1024 * 1024, json_backend='json'):
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(template_path, cache_dir)) as pool:
+        if stream:
+            futures = [pool.submit(convert_stream, path, project, mode, shapes or {}, output_dir, compact, chunk_rows, max_memory,
+                                   json_backend)
+                       for path, project in inputs]
+        else:
+            futures = [pool.submit(convert, path, project, mode, shapes or {}, output_dir, compact, store is not None,
+                                   shard_by, max_shard_nodes, index, format_version, tuple(encodings), json_backend)
+                       for path, project in inputs]
+        for future in as_completed(futures):
+            result = future.result()
+            if store is not None and result['status'] == 'ok':
+                start = time.perf_counter()
+                try:
+                    store.save_many(result.pop('json_rows'))
+                    result['timings']['db'] = time.perf_counter() - start
+                except Exception as e:
+                    result['status'] = 'error'
+                    result['error'] = f"{type(e).__name__}: {e}"
+            result.pop('json_rows', None)
+            results.append(result)
+            print_result(result)
+    return results
+
+
+def print_result(result):
+    timings = ' '.join(f"{stage}={seconds:.2f}s" for stage, seconds in result['timings'].items())
+    line = f"[{result['status']}] {result['file']} ({result['project']}) {timings}"
+    if len(result.get('encodings', {})) > 1:
+        line += ' ' + ' '.join(f"{name}={stats['bytes']}B" for name, stats in result['encodings'].items())
+    if result['error']:
+        line += f" - {result['error']}"
+    print(line, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert Association Map workbooks to JSON without the Streamlit UI.")
+    parser.add_argument('inputs', help="directory of Association Map workbooks or a CSV manifest with path,project columns")
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE, help="Relationshipmap Features workbook")
+    parser.add_argument('--mode', default='Default', choices=MODES)
+    parser.add_argument('--shapes', help="JSON file mapping each SubType to a shape, required for 'Fill from UI'")
+    parser.add_argument('--output-dir', help="write one <name>.json per workbook here")
+    parser.add_argument('--sqlite', help="save the maps to this SQLite database")
+    parser.add_argument('--postgres', help="save the maps to the postgres database at this DSN")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument('--compact', action='store_true', help="write JSON without indentation")
+    parser.add_argument('--json-backend', default='json', choices=('json', 'orjson'),
+                        help="orjson is faster but writes NaN as null and non-ascii text unescaped")
+    parser.add_argument('--cache-dir', help="keep parsed sheets as Arrow files here for later runs")
+    parser.add_argument('--report', help="write per-file results and timings to this JSON file")
+    parser.add_argument('--shard-by', choices=PARTITIONS, help="split each map into shards by connected component, Type or SubType")
+    parser.add_argument('--max-shard-nodes', type=int, default=10000, help="nodes per shard when packing components")
+    parser.add_argument('--index', action='store_true', help="embed neighbour, degree and Type/SubType/connection_type indexes")
+    parser.add_argument('--format-version', type=int, default=1, choices=(1, 2),
+                        help="2 writes each node and edge style once in a 'styles' table that records refer to by id")
+    parser.add_argument('--encodings', nargs='+', default=['json'], choices=list(EXPORT_ENCODINGS),
+                        help="files written to --output-dir for each map: json, json.gz, json.br, msgpack, cbor")
+    parser.add_argument('--stream-connections', action='store_true',
+                        help="read the Connections sheet in chunks under --max-memory-mb; writes to --output-dir only")
+    parser.add_argument('--chunk-rows', type=int, default=50000, help="Connections rows read per chunk when streaming")
+    parser.add_argument('--max-memory-mb', type=int, default=256,
+                        help="connection data held in memory per worker when streaming; the rest is spilled to disk")
+    args = parser.parse_args(argv)
+
+    if not (args.output_dir or args.sqlite or args.postgres):
+        parser.error("give at least one of --output-dir, --sqlite or --postgres")
+    shapes = None
+    if args.mode == 'Fill from UI':
+        if not args.shapes:
+            parser.error("--shapes is required with --mode 'Fill from UI'")
+        with open(args.shapes) as f:
+            shapes = json.load(f)
+    if args.format_version == 2 and args.shard_by:
+        parser.error("--format-version 2 cannot be combined with --shard-by")
+    missing = [name for name in args.encodings if name not in export_encodings()]
+    if missing:
+        parser.error(f"{', '.join(missing)} needs {', '.join(EXPORT_ENCODINGS[name].package for name in missing)} installed")
+    if args.encodings != ['json'] and args.shard_by:
+        parser.error("--encodings cannot be combined with --shard-by")
+    if args.stream_connections:
+        if not args.output_dir or args.sqlite or args.postgres:
+            parser.error("--stream-connections writes to --output-dir only")
+        if args.shard_by or args.index or args.format_version != 1 or args.encodings != ['json']:
+            parser.error("--stream-connections cannot be combined with --shard-by, --index, --format-version or --encodings")
+
+    store = open_store(args) if (args.sqlite or args.postgres) else None
+    start = time.perf_counter()
+    results = run_batch(read_inputs(args.inputs), args.template, args.mode, shapes, args.output_dir, store,
+                        args.workers, args.compact, args.cache_dir, args.shard_by, args.max_shard_nodes, args.index,
+                        args.format_version, args.encodings, args.stream_connections, args.chunk_rows,
+                        args.max_memory_mb * 1024 * 1024, args.json_backend)
+    elapsed = time.perf_counter() - start
+    if store is not None:
+        store.close()
+
+    failed = [result for result in results if result['status'] != 'ok']
+    print(f"{len(results) - len(failed)} converted, {len(failed)} failed in {elapsed:.2f}s")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'elapsed': elapsed, 'results': results}, f, indent=2)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import atexit
+import gzip
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import StringIO
+
+from association_map_metrics import NULL_RUN
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class ConnectionPool:
+    # bounded pool over any DB-API connect() callable. Connections are opened on first
+    # use, set up once with setup(conn), and health-checked with a cheap query when they
+    # have been idle longer than check_interval seconds.
+    def __init__(self, connect, maxconn=5, setup=None, errors=(Exception,), check_interval=30, timeout=30):
+        self.connect = connect
+        self.maxconn = maxconn
+        self.setup = setup
+        self.errors = errors
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.idle = []
+        self.opened = 0
+        self.condition = threading.Condition()
+
+    def open(self):
+        conn = self.connect()
+        if self.setup is not None:
+            self.setup(conn)
+        return conn
+
+    def close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def is_healthy(self, conn):
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchall()
+            cur.close()
+            conn.rollback()
+            return True
+        except self.errors:
+            return False
+
+    def getconn(self):
+        with self.condition:
+            deadline = time.monotonic() + self.timeout
+            while not self.idle and self.opened >= self.maxconn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No database connection available after {self.timeout}s")
+                self.condition.wait(remaining)
+            if self.idle:
+                conn, last_used = self.idle.pop()
+            else:
+                conn, last_used = None, None
+                self.opened += 1
+        try:
+            if conn is None:
+                return self.open()
+            if time.monotonic() - last_used > self.check_interval and not self.is_healthy(conn):
+                self.close(conn)
+                return self.open()
+            return conn
+        except BaseException:
+            self.discard(conn)
+            raise
+
+    def putconn(self, conn):
+        with self.condition:
+            self.idle.append((conn, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self, conn):
+        # drops a broken connection and frees its slot for a fresh one
+        if conn is not None:
+            self.close(conn)
+        with self.condition:
+            self.opened -= 1
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        except self.errors:
+            self.discard(conn)
+            raise
+        except BaseException:
+            conn.rollback()
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.opened -= len(idle)
+        for conn, _ in idle:
+            self.close(conn)
+
+    def stats(self):
+        with self.condition:
+            return {'opened': self.opened, 'idle': len(self.idle), 'maxconn': self.maxconn}
+
+
+def compress_json(data):
+    # zstd when the zstandard package is installed, gzip otherwise
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(data)
+    return 'gzip', gzip.compress(data, compresslevel=6)
+
+def decompress_json(encoding, payload):
+    payload = bytes(payload)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("This map was stored with zstd; install zstandard to read it")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if encoding == 'gzip':
+        return gzip.decompress(payload)
+    if encoding == 'identity':
+        return payload
+    raise ValueError(f"Unknown payload encoding: {encoding}")
+
+
+def copy_escape(value):
+    # text format escaping for COPY ... FROM STDIN
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class JsonStore:
+    # writes generated maps to the json_store table through a ConnectionPool. Inserts are
+    # always parameterized; on postgres they go through a statement prepared once per
+    # connection, and insert_many batches rows with a multi-row VALUES or COPY.
+    #
+    # save()/save_many() store maps content-addressed instead: the compressed JSON goes
+    # once into blob_table keyed by its sha256, and json_store gets a reference row with
+    # the hash in ContentHash and no inline JSON. load() reads a map back by hash.
+    def __init__(self, connect, dialect='postgres', table='json_store', maxconn=5, errors=(Exception,), blob_table='json_blob'):
+        if dialect not in ('postgres', 'sqlite'):
+            raise ValueError(f"Unknown dialect: {dialect}")
+        self.dialect = dialect
+        self.table = table
+        self.blob_table = blob_table
+        self.param = '%s' if dialect == 'postgres' else '?'
+        self.schema_ready = False
+        self.volume = {'maps': 0, 'new_blobs': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+        self.lock = threading.Lock()
+        self.pool = ConnectionPool(connect, maxconn=maxconn, setup=self.prepare, errors=errors)
+
+    def postgres(params, maxconn=5, table='json_store'):
+        import psycopg2
+        return JsonStore(lambda: psycopg2.connect(**params), 'postgres', table, maxconn,
+                         errors=(psycopg2.OperationalError, psycopg2.InterfaceError))
+
+    def sqlite(path, table='json_store'):
+        # stand-in for tests and local runs; creates the table when it does not exist
+        import sqlite3
+
+        def connect():
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (AssociationMapJSON TEXT, AppName TEXT, ContentHash TEXT)")
+            conn.commit()
+            return conn
+        return JsonStore(connect, 'sqlite', table, maxconn=1, errors=(sqlite3.OperationalError, sqlite3.InterfaceError, sqlite3.ProgrammingError))
+
+    def prepare(self, conn):
+        if self.dialect == 'postgres':
+            cur = conn.cursor()
+            cur.execute(f"PREPARE json_store_insert (text, text) AS INSERT INTO {self.table} (AssociationMapJSON, AppName) VALUES ($1, $2)")
+            cur.close()
+            conn.commit()
+
+    def execute(self, work):
+        # runs work(cursor) in one transaction, retrying once on a fresh connection if the
+        # pooled one turns out to be broken
+        for attempt in range(2):
+            try:
+                with self.pool.connection() as conn:
+                    cur = conn.cursor()
+                    try:
+                        result = work(cur)
+                    finally:
+                        cur.close()
+                    conn.commit()
+                    return result
+            except self.pool.errors:
+                if attempt:
+                    raise
+
+    def insert(self, json_text, app_name):
+        if self.dialect == 'postgres':
+            return self.execute(lambda cur: cur.execute("EXECUTE json_store_insert (%s, %s)", (json_text, app_name)))
+        return self.execute(lambda cur: cur.execute(f"INSERT INTO {self.table} (AssociationMapJSON, AppName) VALUES (?, ?)", (json_text, app_name)))
+
+    def insert_many(self, rows, method='values', page_size=100):
+        # rows is a list of (json_text, app_name); method is 'values' or 'copy' on postgres
+        rows = list(rows)
+        if not rows:
+            return
+        if self.dialect == 'sqlite':
+            return self.execute(lambda cur: cur.executemany(f"INSERT INTO {self.table} (AssociationMapJSON, AppName) VALUES (?, ?)", rows))
+        if method == 'copy':
+            def copy(cur):
+                buffer = StringIO()
+                for json_text, app_name in rows:
+                    buffer.write(copy_escape(json_text) + '\t' + copy_escape(app_name) + '\n')
+                buffer.seek(0)
+                cur.copy_expert(f"COPY {self.table} (AssociationMapJSON, AppName) FROM STDIN", buffer)
+            return self.execute(copy)
+        from psycopg2.extras import execute_values
+        return self.execute(lambda cur: execute_values(cur, f"INSERT INTO {self.table} (AssociationMapJSON, AppName) VALUES %s", rows, page_size=page_size))
+
+    def ensure_schema(self):
+        # blob table and the ContentHash reference column, created once per store. The DDL
+        # commits in its own transaction and the flag is only set once it has, so a failed
+        # or rolled back attempt is retried by the next call
+        if self.schema_ready:
+            return
+        blob_type = 'BYTEA' if self.dialect == 'postgres' else 'BLOB'
+
+        def work(cur):
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {self.blob_table} (ContentHash TEXT PRIMARY KEY, Encoding TEXT NOT NULL, "
+                        f"Payload {blob_type} NOT NULL, RawSize BIGINT NOT NULL, StoredSize BIGINT NOT NULL, "
+                        f"Created TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+            if self.dialect == 'postgres':
+                cur.execute(f"ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS ContentHash TEXT")
+
+        self.execute(work)
+        self.schema_ready = True
+
+    def save(self, json_bytes, app_name):
+        return self.save_many([(json_bytes, app_name)])[0]
+
+    def write_rows(self, cur, statement, rows, page_size=100):
+        # statement holds one VALUES %s, filled by execute_values on postgres and by a row of
+        # placeholders for executemany on sqlite
+        if not rows:
+            return
+        if self.dialect == 'postgres':
+            from psycopg2.extras import execute_values
+            return execute_values(cur, statement, rows, page_size=page_size)
+        cur.executemany(statement.replace('%s', '(' + ', '.join('?' * len(rows[0])) + ')'), rows)
+
+    def save_many(self, rows):
+        # rows is a list of (json_bytes, app_name); returns the content hash of each row.
+        # Known hashes are looked up with one query, and the new blobs and the reference
+        # rows are each written in one batch
+        rows = [(hashlib.sha256(json_bytes).hexdigest(), json_bytes, app_name) for json_bytes, app_name in rows]
+        blobs = {}
+        for digest, json_bytes, _ in rows:
+            blobs.setdefault(digest, json_bytes)
+
+        def work(cur):
+            digests = list(blobs)
+            if self.dialect == 'postgres':
+                cur.execute(f"SELECT ContentHash FROM {self.blob_table} WHERE ContentHash = ANY(%s)", (digests,))
+            else:
+                cur.execute(f"SELECT ContentHash FROM {self.blob_table} WHERE ContentHash IN ({', '.join('?' * len(digests))})", digests)
+            existing = {digest for digest, in cur.fetchall()}
+            volume = {'maps': len(rows), 'new_blobs': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+            new_blobs = []
+            for digest in digests:
+                if digest not in existing:
+                    encoding, payload = compress_json(blobs[digest])
+                    new_blobs.append((digest, encoding, payload, len(blobs[digest]), len(payload)))
+                    volume['new_blobs'] += 1
+                    volume['raw_bytes'] += len(blobs[digest])
+                    volume['stored_bytes'] += len(payload)
+            self.write_rows(cur, f"INSERT INTO {self.blob_table} (ContentHash, Encoding, Payload, RawSize, StoredSize) VALUES %s "
+                                 f"ON CONFLICT (ContentHash) DO NOTHING", new_blobs)
+            self.write_rows(cur, f"INSERT INTO {self.table} (AssociationMapJSON, AppName, ContentHash) VALUES %s",
+                            [(None, app_name, digest) for digest, _, app_name in rows])
+            return volume
+
+        if not rows:
+            return []
+        self.ensure_schema()
+        volume = self.execute(work)
+        with self.lock:
+            for key, value in volume.items():
+                self.volume[key] += value
+        return [digest for digest, _, _ in rows]
+
+    def load(self, content_hash):
+        def work(cur):
+            cur.execute(f"SELECT Encoding, Payload FROM {self.blob_table} WHERE ContentHash = {self.param}", (content_hash,))
+            return cur.fetchone()
+        self.ensure_schema()
+        row = self.execute(work)
+        if row is None:
+            return None
+        return decompress_json(*row)
+
+    def healthy(self):
+        try:
+            with self.pool.connection() as conn:
+                return self.pool.is_healthy(conn)
+        except Exception:
+            return False
+
+    def close(self):
+        self.pool.closeall()
+
+
+class SaveJob:
+    def __init__(self, job_id, key, project, json_bytes):
+        self.job_id = job_id
+        self.key = key
+        self.project = project
+        self.json_bytes = json_bytes
+        self.status = 'queued'
+        self.attempts = 0
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+
+    def as_dict(self):
+        return {'job_id': self.job_id, 'project': self.project, 'status': self.status, 'attempts': self.attempts,
+                'error': self.error, 'submitted': self.submitted, 'finished': self.finished}
+
+
+class WriteBehindQueue:
+    # saves generated maps on a background thread so the page does not wait on the
+    # database. submit() returns a job id immediately; a (project, JSON) pair that is
+    # already queued or saved returns the existing job instead of writing a second row.
+    # Jobs that arrive together are written with one save_many, and failed writes are
+    # retried with exponential backoff before the job is marked failed. With metrics (a
+    # PipelineMetrics), each batch is recorded as a db_write stage.
+    def __init__(self, store, max_retries=5, backoff=0.5, max_backoff=30, batch_size=20, history=1000, metrics=None):
+        self.store = store
+        self.metrics = metrics
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.history = history
+        self.queue = queue.Queue()
+        self.jobs = OrderedDict()
+        self.keys = {}
+        self.pending = 0
+        self.next_id = 1
+        self.lock = threading.Condition()
+        self.stopping = threading.Event()
+        self.worker = threading.Thread(target=self.run, name='json-store-writer', daemon=True)
+        self.worker.start()
+        atexit.register(self.shutdown)
+
+    def submit(self, project, json_bytes):
+        if self.stopping.is_set():
+            raise RuntimeError("The save queue has been shut down")
+        key = (project, hashlib.sha256(json_bytes).hexdigest())
+        with self.lock:
+            job_id = self.keys.get(key)
+            if job_id is not None and self.jobs[job_id].status != 'failed':
+                return job_id
+            job = SaveJob(self.next_id, key, project, json_bytes)
+            self.next_id += 1
+            self.jobs[job.job_id] = job
+            self.keys[key] = job.job_id
+            self.pending += 1
+            self.forget_old_jobs()
+        self.queue.put(job)
+        return job.job_id
+
+    def forget_old_jobs(self):
+        while len(self.jobs) > self.history:
+            job_id, job = next(iter(self.jobs.items()))
+            if job.status in ('queued', 'writing'):
+                break
+            del self.jobs[job_id]
+            if self.keys.get(job.key) == job_id:
+                del self.keys[job.key]
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else job.as_dict()
+
+    def depth(self):
+        with self.lock:
+            return self.pending
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.queue.put(None)
+                    break
+                batch.append(job)
+            self.write(batch)
+
+    def write(self, batch):
+        for job in batch:
+            job.status = 'writing'
+        rows = [(job.json_bytes, job.project) for job in batch]
+        error = None
+        run = NULL_RUN if self.metrics is None else self.metrics.run()
+        with run.stage('db_write', rows_in=len(rows)) as record:
+            for attempt in range(self.max_retries + 1):
+                for job in batch:
+                    job.attempts = attempt + 1
+                try:
+                    self.store.save_many(rows)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    if attempt < self.max_retries:
+                        time.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+            record['rows_out'] = 0 if error is not None else len(rows)
+        run.finish()
+        with self.lock:
+            for job in batch:
+                job.status = 'failed' if error is not None else 'done'
+                job.error = None if error is None else str(error)
+                job.finished = time.time()
+                if error is None:
+                    job.json_bytes = None
+            self.pending -= len(batch)
+            self.lock.notify_all()
+
+    def flush(self, timeout=None):
+        # waits until every submitted job is done or failed; False when timeout runs out first
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while self.pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def shutdown(self, timeout=30):
+        if self.stopping.is_set():
+            return True
+        self.stopping.set()
+        flushed = self.flush(timeout)
+        self.queue.put(None)
+        self.worker.join(timeout=1)
+        return flushed
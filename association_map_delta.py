@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import heapq
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from association_map_metrics import NULL_RUN
+from association_map_utils import (ConnectionProcessor, JsonStreamEncoder, NodeProcessor, NodeProcessor1, build_header,
+                                   build_index, build_legend, index_node_frame)
+
+
+class MapRevision:
+    # everything needed to regenerate a project's map from the next upload without a full
+    # rebuild: the node records by Node Id with a hash of the row each came from, the
+    # edge records in document order with the (from, to, Level, occurrence) key of each,
+    # and the context (template, mode, shapes and sheet dtypes) they were built under.
+    # origin is the app's result cache key of the map, when it has one
+    def __init__(self, context, header, node_hashes, nodes, node_order, edge_keys, edges, next_uid, size=0, origin=None):
+        self.context = context
+        self.header = header
+        self.node_hashes = node_hashes
+        self.nodes = nodes
+        self.node_order = node_order
+        self.edge_keys = edge_keys
+        self.edges = edges
+        self.next_uid = next_uid
+        self.size = size
+        self.origin = origin
+
+    def node_list(self):
+        return [self.nodes[uid] for uid in self.node_order]
+
+
+class RevisionBase:
+    # a project's last full build (generate_json) kept in place of its MapRevision: the
+    # JsonResult and the Association Map workbook it came from. revision() makes the
+    # MapRevision from the result's parsed document once an upload of the project needs
+    # it, so a first build does not pay for records only a re-upload uses. It is counted
+    # at the size of the revision it stands for
+    def __init__(self, context, result, bundle_AM, bundle_RM, origin=None):
+        self.context = context
+        self.result = result
+        self.bundle_AM = bundle_AM
+        self.map_feature = bundle_RM.sheets
+        self.origin = origin
+        self.size = REVISION_SIZE_FACTOR * len(result.json_bytes)
+
+    def revision(self):
+        # None when the document's edges do not line up with the Connections rows, which
+        # makes the next build a full one
+        document = self.result.document()
+        node_df = self.bundle_AM['Node']
+        connection_df = self.bundle_AM['Connections']
+        node_records = document['default']['node']
+        edges = document['default']['node_connections']
+        # a full build lists the valid connections stably sorted by 'from'
+        valid = valid_connections(node_df, connection_df, self.map_feature)
+        order = np.argsort(connection_df['from'][valid].to_numpy(dtype='int64'), kind='stable')
+        keys = edge_keys(connection_df)[valid].iloc[order].tolist()
+        if len(keys) != len(edges) or any(key[:2] != (edge['from'], edge['to']) for key, edge in zip(keys, edges)):
+            return None
+        header = {key: value for key, value in document.items() if key != 'default'}
+        return MapRevision(self.context, header, node_row_hashes(node_df), {node['UID']: node for node in node_records},
+                           [node['UID'] for node in node_records], keys, edges, max((edge['UID'] for edge in edges), default=0) + 1,
+                           self.size, self.origin)
+
+
+# the record dicts of a revision take about this multiple of its encoded JSON size
+REVISION_SIZE_FACTOR = 4
+
+
+class RevisionStore:
+    # LRU of the latest MapRevision (or RevisionBase) of each project, bounded by project
+    # count and by the estimated bytes of the revisions. A revision bigger than max_bytes
+    # is not kept, so that project's next upload is a full rebuild
+    def __init__(self, maxsize=32, max_bytes=256 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, project):
+        with self.lock:
+            revision = self.entries.get(project)
+            if revision is not None:
+                self.entries.move_to_end(project)
+            return revision
+
+    def put(self, project, revision):
+        with self.lock:
+            old = self.entries.pop(project, None)
+            if old is not None:
+                self.total_bytes -= old.size
+            if revision.size > self.max_bytes:
+                return
+            self.entries[project] = revision
+            self.total_bytes += revision.size
+            while len(self.entries) > self.maxsize or self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+
+
+class Regeneration:
+    # result of regenerate(): the new revision, its encoded document, the RFC 6902 patch
+    # from the previous revision (None on the first generation) and what was rebuilt
+    def __init__(self, revision, json_bytes, patch, stats):
+        self.revision = revision
+        self.json_bytes = json_bytes
+        self.patch = patch
+        self.stats = stats
+
+
+def dtype_signature(df):
+    return tuple((str(col), str(dtype)) for col, dtype in df.dtypes.items())
+
+
+def node_row_hashes(node_df):
+    # Node Id -> hash of every cell of its row
+    hashes = pd.util.hash_pandas_object(node_df, index=False).to_numpy()
+    return dict(zip(node_df['Node Id'].astype('int64').tolist(), hashes.tolist()))
+
+
+def revision_context(bundle_AM, bundle_RM, choice1, d):
+    # what a revision's records depend on besides the rows: template, mode, shapes and sheet dtypes
+    return (bundle_RM.digest, choice1, tuple(sorted(d.items())) if choice1 == 'Fill from UI' else (),
+            dtype_signature(bundle_AM['Node']), dtype_signature(bundle_AM['Connections']))
+
+
+def valid_connections(node_df, connection_df, map_feature):
+    # the connection rows a full build turns into edges
+    node_ids = node_df['Node Id']
+    return (connection_df['from'].isin(node_ids) & connection_df['to'].isin(node_ids)
+            & connection_df['Level'].isin(map_feature['Edge']['L2']))
+
+
+def edge_keys(connection_df):
+    # (from, to, Level, occurrence) of every connection row; occurrence numbers repeats of
+    # the same triple so duplicate rows stay distinct edges
+    occurrence = connection_df.groupby(['from', 'to', 'Level'], dropna=False, sort=False).cumcount()
+    return pd.Series(list(zip(connection_df['from'].tolist(), connection_df['to'].tolist(),
+                              connection_df['Level'].tolist(), occurrence.tolist())), index=connection_df.index)
+
+
+def build_nodes(node_df, map_feature, connection_df, choice1, d, dict1, styles=None):
+    if choice1 == 'Fill from UI':
+        return NodeProcessor(node_df, map_feature, connection_df, d, dict1, styles).process_node_data(node_df, map_feature, connection_df, d, dict1)
+    return NodeProcessor1(node_df, map_feature, connection_df, styles).process_node_data(node_df, map_feature, connection_df)
+
+
+def build_edges(node_df, map_feature, connection_df, keys, styles=None):
+    # edge records for the given connection rows in the order a full build lists them,
+    # each paired with its key; UIDs are assigned by the caller
+    frame = ConnectionProcessor(node_df, map_feature, connection_df, keyed=True, styles=styles).build_connection_frame()
+    frame_keys = keys.loc[frame['row']].tolist()
+    records = frame.drop(columns=['row', 'Level']).to_dict('records')
+    return frame_keys, records
+
+
+def regenerate(bundle_AM, bundle_RM, choice1, d, dict1, distinct_values, previous=None, encoder=None, run=NULL_RUN, index=False,
+               styles=None):
+    # builds the same document as generate_json, reusing previous (the project's last
+    # MapRevision) where it still applies: nodes whose row hash is unchanged and edges whose
+    # key survives are carried over, and only the rest are built. Edges keep the UID they
+    # were first given; new edges are numbered after the highest UID handed out so far.
+    # A RevisionBase as previous is turned into its MapRevision first.
+    node_df = bundle_AM['Node']
+    connection_df = bundle_AM['Connections']
+    map_feature = bundle_RM.sheets
+    context = revision_context(bundle_AM, bundle_RM, choice1, d)
+    if isinstance(previous, RevisionBase):
+        previous = previous.revision()
+    reuse = previous is not None and previous.context == context
+
+    with run.stage('node_build', rows_in=len(node_df)) as record:
+        node_hashes = node_row_hashes(node_df)
+        if reuse:
+            changed = {uid for uid, h in node_hashes.items() if previous.node_hashes.get(uid) != h}
+            rebuilt = build_nodes(node_df[node_df['Node Id'].isin(changed)], map_feature, connection_df, choice1, d, dict1, styles) if changed else []
+            nodes = {uid: previous.nodes[uid] for uid in node_hashes if uid in previous.nodes and uid not in changed}
+        else:
+            rebuilt = build_nodes(node_df, map_feature, connection_df, choice1, d, dict1, styles)
+            nodes = {}
+        nodes.update((node['UID'], node) for node in rebuilt)
+        # a full build lists nodes in sheet order, leaving out SubTypes missing from the template
+        node_order = [uid for uid in node_hashes if uid in nodes]
+        record['rows_out'] = len(rebuilt)
+
+    with run.stage('edge_build', rows_in=len(connection_df)) as record:
+        keys = edge_keys(connection_df)
+        valid = valid_connections(node_df, connection_df, map_feature)
+        old_uids = {} if previous is None else {key: edge['UID'] for key, edge in zip(previous.edge_keys, previous.edges)}
+        next_uid = 1 if previous is None else previous.next_uid
+        if reuse:
+            wanted = set(keys[valid])
+            kept = [(key, edge) for key, edge in zip(previous.edge_keys, previous.edges) if key in wanted]
+            new_rows = valid & ~keys.map(old_uids.__contains__).astype(bool)
+            new_keys, new_edges = build_edges(node_df, map_feature, connection_df[new_rows], keys, styles) if new_rows.any() else ([], [])
+        else:
+            kept = []
+            new_keys, new_edges = build_edges(node_df, map_feature, connection_df, keys, styles)
+        for key, edge in zip(new_keys, new_edges):
+            if key in old_uids:
+                edge['UID'] = old_uids[key]
+            else:
+                edge['UID'] = next_uid
+                next_uid += 1
+        # kept edges are already ordered by 'from'; new ones slot in after equal 'from' values
+        merged = list(heapq.merge(kept, zip(new_keys, new_edges), key=lambda pair: pair[1]['from']))
+        edges = [edge for key, edge in merged]
+        record['rows_out'] = len(new_edges)
+
+    with run.stage('legend', rows_in=len(distinct_values)) as record:
+        header = build_header(map_feature, node_df, build_legend(map_feature, choice1, d, dict1, distinct_values, styles))
+        record['rows_out'] = len(header['legend'])
+    if index:
+        with run.stage('index', rows_in=len(node_order) + len(edges)):
+            edge_frame = pd.DataFrame(edges, columns=['from', 'to', 'UID', 'connection_type'])
+            header['index'] = build_index(index_node_frame(node_df, map_feature), edge_frame)
+
+    revision = MapRevision(context, header, node_hashes, nodes, node_order, [key for key, edge in merged], edges, next_uid)
+    if encoder is None:
+        encoder = JsonStreamEncoder()
+    with run.stage('json_encode') as record:
+        json_bytes = encoder.encode(header, revision.node_list(), edges)
+        record['bytes'] = len(json_bytes)
+    revision.size = REVISION_SIZE_FACTOR * len(json_bytes)
+
+    patch = None
+    if previous is not None:
+        patch = diff_documents(previous, revision)
+    stats = {'incremental': reuse, 'nodes_rebuilt': len(rebuilt), 'edges_rebuilt': len(new_edges),
+             'nodes': len(node_order), 'edges': len(edges), 'patch_ops': None if patch is None else len(patch)}
+    return Regeneration(revision, json_bytes, patch, stats)
+
+
+# RFC 6902 JSON Patch between two revisions. Node and edge arrays are matched by UID, so
+# an edited record becomes replace operations on just the fields that changed, and
+# added and removed records become add and remove operations at their array index.
+def pointer(*parts):
+    return ''.join('/' + str(part).replace('~', '~0').replace('/', '~1') for part in parts)
+
+
+def same(old, new):
+    if isinstance(old, float) and isinstance(new, float) and np.isnan(old) and np.isnan(new):
+        return True
+    return type(old) is type(new) and old == new
+
+
+def diff_values(old, new, path, ops):
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in old:
+            if key not in new:
+                ops.append({'op': 'remove', 'path': path + pointer(key)})
+        for key, value in new.items():
+            if key not in old:
+                ops.append({'op': 'add', 'path': path + pointer(key), 'value': value})
+            else:
+                diff_values(old[key], value, path + pointer(key), ops)
+    elif not same(old, new):
+        ops.append({'op': 'replace', 'path': path, 'value': new})
+
+
+def diff_records(old, new, path, ops):
+    new_by_uid = {record['UID']: record for record in new}
+    old_by_uid = {record['UID']: record for record in old}
+    if [r['UID'] for r in old if r['UID'] in new_by_uid] != [r['UID'] for r in new if r['UID'] in old_by_uid]:
+        # surviving records were reordered; one replace is smaller than a run of moves
+        ops.append({'op': 'replace', 'path': path, 'value': new})
+        return
+    for index in range(len(old) - 1, -1, -1):
+        if old[index]['UID'] not in new_by_uid:
+            ops.append({'op': 'remove', 'path': path + pointer(index)})
+    for index, record in enumerate(new):
+        previous = old_by_uid.get(record['UID'])
+        if previous is None:
+            ops.append({'op': 'add', 'path': path + pointer(index), 'value': record})
+        elif previous is not record:
+            diff_values(previous, record, path + pointer(index), ops)
+
+
+def diff_documents(old, new):
+    ops = []
+    diff_values(old.header, new.header, '', ops)
+    diff_records(old.node_list(), new.node_list(), pointer('default', 'node'), ops)
+    diff_records(old.edges, new.edges, pointer('default', 'node_connections'), ops)
+    return ops
+
+
+def apply_patch(document, patch):
+    # applies the add/remove/replace operations diff_documents produces, in place
+    for op in patch:
+        parts = [part.replace('~1', '/').replace('~0', '~') for part in op['path'].split('/')[1:]]
+        if not parts:
+            document = op['value']
+            continue
+        target = document
+        for part in parts[:-1]:
+            target = target[int(part)] if isinstance(target, list) else target[part]
+        last = parts[-1]
+        if isinstance(target, list):
+            index = len(target) if last == '-' else int(last)
+            if op['op'] == 'add':
+                target.insert(index, op['value'])
+            elif op['op'] == 'remove':
+                del target[index]
+            else:
+                target[index] = op['value']
+        elif op['op'] == 'remove':
+            del target[last]
+        else:
+            target[last] = op['value']
+    return document
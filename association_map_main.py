@@ -1,381 +1,295 @@
 import streamlit as st
-import firebase_admin
-
-from firebase_admin import credentials
-from firebase_admin import auth
 
+import os
 import pandas as pd
-import json
-from io import BytesIO
-
-import psycopg2
 
-from association_map_utils import NodeProcessor1, NodeProcessor, ConnectionProcessor, GlobalProcessor, GlobalProcessor1, JsonGenerator, write_json_to_file
-
-# @st.cache_resource
+from association_map_db import JsonStore, WriteBehindQueue
+from association_map_delta import RevisionBase, RevisionStore, regenerate, revision_context
+from association_map_shards import PARTITIONS, shard_document
+from association_map_metrics import NULL_RUN, PipelineMetrics
+from association_map_validation import READ_COLUMNS, READ_DTYPES, SHEET_SCHEMAS, ValidationCache, validate_workbooks
+from association_map_utils import SHAPE_IMAGES, ExcelReader, JsonResult, JsonStreamEncoder, ResultCache, SheetDiskCache, StyleTables, WorkbookCache, WorkbookLoader, EXPORT_ENCODINGS, encode_v2, export_encodings, generate_json
+
+# Firebase is imported and initialised on the first login or sign up instead of when
+# the app starts, so a new replica shows the login form straight away
+@st.cache_resource
+def get_firebase_auth():
+    import firebase_admin
+    from firebase_admin import auth, credentials
+    if not firebase_admin._apps:
+        cred = credentials.Certificate('login-f7584-3a8c6c70f3a2.json')
+        firebase_admin.initialize_app(cred)
+    return auth
+
+
+# Pooled connections to the json_store database, shared by every session. Nothing
+# connects until the first save, which runs on the save queue's thread
+@st.cache_resource
 def init_connection():
-    return psycopg2.connect(**st.secrets["postgres"])
-
-conn = init_connection()
+    return JsonStore.postgres(st.secrets["postgres"], maxconn=5)
 
 
-# Perform query.
-# Uses st.experimental_memo to only rerun when the query change
-@st.cache_data(ttl=600)
-def run_query(query):
-    with conn.cursor() as cur:
-        cur.execute(query)
-        conn.commit()
-        cur.close()
-        conn.close()
-
-        st.success("Data inserted successfully!")
+# Background writer so the page does not wait on the database
+@st.cache_resource
+def get_save_queue():
+    return WriteBehindQueue(init_connection(), metrics=get_metrics())
 
 
-# Validation function
-def validate_excel(file_path1, file_path2):
-    # Load Excel file
-    try:
-        xls_AM = pd.ExcelFile(file_path1)
-        xls_RM = pd.ExcelFile(file_path2)
-    except pd.errors.ExcelFileNotFound:
-        st.error("File not found. Please upload a valid Excel file.")
-        return None
+# Per-stage timings, memory and row counts for every session, turned on with
+# ASSOCIATION_MAP_METRICS=1 (see PipelineMetrics.from_env)
+@st.cache_resource
+def get_metrics():
+    return PipelineMetrics.from_env()
 
-    # Check for number of sheets
-    sheets_AM = xls_AM.sheet_names
-    if "Node" not in sheets_AM or "Connections" not in sheets_AM:
-        st.error("Missing required sheets. Please include 'Node' and 'Connections' in Association Map Excel File.")
-        return None
-    
-    sheets_RM = xls_RM.sheet_names
-    if "Nodes" not in sheets_RM or "Edge" not in sheets_RM or "Global" not in sheets_RM or "Global" not in sheets_RM:
-        st.error("Missing required sheets. Please include 'Nodes', 'Edge' and 'Global' in Relationshipmap Features Excel File.")
-        return None
 
-    # Load data from sheets
-    nodes_df = pd.read_excel(xls_AM, "Node")
-    connections_df = pd.read_excel(xls_AM, "Connections")
-    node_com_df = pd.read_excel(xls_RM, "Nodes")
-    edge_df = pd.read_excel(xls_RM, "Edge")
-    global_df = pd.read_excel(xls_RM, "Global")
+# JSON encoder backend: 'json' keeps the output byte-identical to json.dumps(indent=2);
+# ASSOCIATION_MAP_JSON_BACKEND=orjson (or auto) trades that for speed
+JSON_BACKEND = os.environ.get("ASSOCIATION_MAP_JSON_BACKEND", "json")
 
-    # Validate columns in sheets
-    node_columns = ['Node Id', 'Name', 'Type', 'Relationship', 'SubType',
-                    'data_grid_title1', 'data_grid_info1', 'data_grid_title2', 'data_grid_info2',
-                    'data_grid_title3', 'data_grid_info3', 'data_grid_title4', 'data_grid_info4',
-                    'data_grid_title5', 'data_grid_info5']
+# features workbook used by the 'Default' and 'Fill from UI' modes
+FEATURES_TEMPLATE = 'Relationshipmap Features Template.xlsx'
 
-    connections_columns = ['UId', 'from', 'to', 'Level']
 
-    node_com_columns = ['Component', 'node_image', 'node_color', 'node_label_font_alignment', 'node_label_font_color', 'node_label_font_background', 'node_label_font_size', 'node_shape', 'node_size', 'node_shadow']
-    edge_columns = ['L2', 'edge_width', 'edge_color', 'edge_length', 'edge_dashes', 'connection_type']
-    global_columns = ['client_name', 'logo_url', 'sidebar_short_logo', 'background_mode', 'legend_Target Entity', 'legend_Organisation', 'legend_Individual', 'legend_Observations']
+def sheet_rows(bundle, sheets=None):
+    return sum(len(df) for name, df in bundle.sheets.items() if df is not None and (sheets is None or name in sheets))
 
-    if not all(col in nodes_df.columns for col in node_columns):
-        st.error("Missing columns in 'Node' sheet Association Map.")
-        return None
 
-    if not all(col in connections_df.columns for col in connections_columns):
-        st.error("Missing columns in 'Connections' sheet Association Map.")
-        return None
-    
-    if not all(col in node_com_df.columns for col in node_com_columns):
-        st.error("Missing columns in 'Nodes' sheet of Relationshipmap Features.")
-        return None
-
-    if not all(col in edge_df.columns for col in edge_columns):
-        st.error("Missing columns in 'Edge' sheet of Relationshipmap Features.")
-        return None
-    
-    if not all(col in global_df.columns for col in global_columns):
-        st.error("Missing columns in 'Global' sheet of Relationshipmap Features.")
-        return None
-
-    # Check for blank rows in both sheets
-    empty_rows = nodes_df[nodes_df.isnull().all(axis=1) | (nodes_df == '').all(axis=1)]
-    # Check if there are any empty rows
-    if len(empty_rows) > 0:
-        st.error("Empty rows in node sheet of Association Map")
-        return None
-
-    empty_rows = connections_df[connections_df.isnull().all(axis=1) | (connections_df == '').all(axis=1)]
-    # Check if there are any empty rows
-    if len(empty_rows) > 0:
-        st.error("Empty rows in Connection sheet of Association Map")
-        return None
-
-    empty_rows = node_com_df[node_com_df.isnull().all(axis=1) | (node_com_df == '').all(axis=1)]
-    # Check if there are any empty rows
-    if len(empty_rows) > 0:
-        st.error("Empty rows in nodes sheet of Relationshipmap Features")
-        return None
-    
-    empty_rows = edge_df[edge_df.isnull().all(axis=1) | (edge_df == '').all(axis=1)]
-    # Check if there are any empty rows
-    if len(empty_rows) > 0:
-        st.error("Empty rows in edge sheet of Relationshipmap Features")
-        return None
-    
-    empty_rows = global_df[global_df.isnull().all(axis=1) | (global_df == '').all(axis=1)]
-    # Check if there are any empty rows
-    if len(empty_rows) > 0:
-        st.error("Empty rows in global sheet of Relationshipmap Features")
-        return None
-    
+def show_metrics_panel():
+    metrics = get_metrics()
+    if not metrics.enabled or not st.sidebar.checkbox("Show pipeline metrics"):
+        return
+    run = st.session_state.get('pipeline_run')
+    if run is not None and run.stages:
+        st.sidebar.markdown("**Last generation**")
+        st.sidebar.dataframe(pd.DataFrame(run.stages), hide_index=True)
+    summary = metrics.summary()
+    if summary:
+        st.sidebar.markdown("**All sessions**")
+        st.sidebar.dataframe(pd.DataFrame(summary), hide_index=True)
 
-    # Validate datatypes using pd.to_numeric and pd.to_datetime
-    node_datatypes = {'Node Id': 'int', 'Name': 'string', 'Type': 'string', 'Relationship': 'string',
-                      'SubType': 'string', 'data_grid_title1': 'string', 'data_grid_info1': 'string',
-                      'data_grid_title2': 'string', 'data_grid_info2': 'string',
-                      'data_grid_title3': 'string', 'data_grid_info3': 'string',
-                      'data_grid_title4': 'string', 'data_grid_info4': 'string',
-                      'data_grid_title5': 'string', 'data_grid_info5': 'string'}
 
-    connections_datatypes = {'UId': 'string', 'from': 'int', 'to': 'int', 'Level': 'string'}
-
-    node_com_datatypes = {'Component': 'string', 'node_image': 'string', 'node_color': 'string', 'node_label_font_alignment': 'string', 'node_label_font_color': 'string', 'node_label_font_background': 'string', 'node_label_font_size': 'int', 'node_shape': 'string', 'node_size': 'int', 'node_shadow':'int'}
-    edge_datatypes = {'L2': 'string', 'edge_width': 'int', 'edge_color': 'string', 'edge_length': 'int', 'edge_dashes': 'int', 'connection_type': 'string'}
-    global_datatypes = {'client_name': 'string', 'logo_url': 'string', 'sidebar_short_logo': 'string', 'background_mode': 'string', 'legend_Target Entity': 'string', 'legend_Organisation': 'string', 'legend_Individual': 'string', 'legend_Observations': 'string'}
-    
-    try:
-        nodes_df = nodes_df.astype(node_datatypes)
-    except ValueError as e:
-        st.error(f"Invalid datatypes in 'Node' sheet: {e}")
-        return None
-
-    try:
-        connections_df = connections_df.astype(connections_datatypes)
-    except ValueError as e:
-        st.error(f"Invalid datatypes in 'Connections' sheet: {e}")
-        return None
-
-    try:
-        node_com_df = node_com_df.astype(node_com_datatypes)
-    except ValueError as e:
-        st.error(f"Invalid datatypes in 'Nodes' sheet: {e}")
-        return None
-
-    try:
-        edge_df = edge_df.astype(edge_datatypes)
-    except ValueError as e:
-        st.error(f"Invalid datatypes in 'Edge' sheet: {e}")
-        return None
-
-    try:
-        global_df = global_df.astype(global_datatypes)
-    except ValueError as e:
-        st.error(f"Invalid datatypes in 'Global' sheet: {e}")
-        return None
-  
-
-    # Logical validation rules
-    # Rule 1: Subtype of the node should be present in the component column in sheet Nodes
-    # of another excel file named relationshipmap Features
-    relationshipmap_features = pd.read_excel(xls_RM, 'Nodes')
-    if not nodes_df['SubType'].isin(relationshipmap_features['Component']).all():
-        st.error("Subtype of the node should be present in the component column in sheet Nodes")
-        return None
-
-    # Rule 2: Node ID should be distinct in Node sheet
-    if not nodes_df['Node Id'].is_unique:
-        st.error("Duplicate Node IDs found in Node sheet.")
-        return None
-
-    # Rule 3: Node Id should exist in Node sheet for all the ids present in 'From' and 'To' of Connections sheet
-    connection_node_ids = set(connections_df['from'].tolist() + connections_df['to'].tolist())
-    if not set(nodes_df['Node Id']).issuperset(connection_node_ids):
-        st.error("Node IDs in Connections not found in Node.")
-        return None
-
-    # Rule 4: Level in Sample Format – Connections should be present in the L2 column of Edge - Default
-    # sheet in relationshipmapfeatures excel file
-    edge_default_sheet = pd.read_excel(xls_RM, 'Edge')
-    if not connections_df['Level'].isin(edge_default_sheet['L2']).all():
-        st.error("Level in Sample Format - Connections should be present in the L2 column of Edge - Default sheet.")
-        return None
-
-    # Rule 5: Check if it has More than 1 Target Entity in SubType column of Node
-    target_value = 'Target Entity'
-    target_entity_count = nodes_df['SubType'].eq(target_value).sum()
-    if (target_entity_count > 1).any():
-        st.error("More than 1 Target Entity found in SubType column of Node.")
-        return None
-
-    # Rule 6: In Connections for all values in 'From' column, there should be a value in 'To' column
-    missing_to_values = connections_df[connections_df['from'].isin(nodes_df['Node Id']) & connections_df['to'].isna()]
-    if not missing_to_values.empty:
-        st.error("In Sample Format - Connections, missing 'To' values for some 'From' values.")
-        return None
-
-    # If all logical validations pass, return the validated dataframes
-    return nodes_df, connections_df, node_com_df, edge_df, global_df
-
-# Validation function for choose from UI part
-def validate_excel1(file_path1, file_path2):
-    # Load Excel file
+# queueing the JSON for insertion into the database
+def save_json(json_bytes, project):
     try:
-        xls_AM = pd.ExcelFile(file_path1)
-        xls_RM = pd.ExcelFile(file_path2)
-    except pd.errors.ExcelFileNotFound:
-        st.error("File not found. Please upload a valid Excel file.")
-        return None
+        st.session_state.save_job = get_save_queue().submit(project, json_bytes)
+    except Exception as e:
+        st.warning(f"The map could not be queued for saving: {e}")
+
+
+def show_save_status():
+    if st.session_state.get('save_job') is None:
+        return
+    save_queue = get_save_queue()
+    job = save_queue.status(st.session_state.save_job)
+    if job is None:
+        return
+    if job['status'] == 'done':
+        st.success("Data inserted successfully!")
+        volume = init_connection().volume
+        st.caption(f"Stored {volume['maps']} maps as {volume['new_blobs']} new blobs, {volume['raw_bytes']} bytes compressed to {volume['stored_bytes']}")
+    elif job['status'] == 'failed':
+        st.error(f"Saving to the database failed after {job['attempts']} attempts: {job['error']}")
+    else:
+        st.info(f"Saving to the database: {job['status']} ({save_queue.depth()} in queue)")
+        st.button("Refresh save status")
 
-    # Check for number of sheets
-    sheets_AM = xls_AM.sheet_names
-    if "Node" not in sheets_AM or "Connections" not in sheets_AM:
-        st.error("Missing required sheets. Please include 'Node' and 'Connections' in Association Map Excel File.")
-        return None
-    
-    sheets_RM = xls_RM.sheet_names
-    if "Nodes" not in sheets_RM or "Edge" not in sheets_RM or "Global" not in sheets_RM or "Global" not in sheets_RM:
-        st.error("Missing required sheets. Please include 'Nodes', 'Edge' and 'Global' in Relationshipmap Features Excel File.")
-        return None
 
-    # Load data from sheets
-    nodes_df = pd.read_excel(xls_AM, "Node")
-    connections_df = pd.read_excel(xls_AM, "Connections")
-    node_com_df = pd.read_excel(xls_RM, "Nodes")
-    edge_df = pd.read_excel(xls_RM, "Edge")
-    global_df = pd.read_excel(xls_RM, "Global")
+# Parsed workbooks shared by every session and rerun, keyed by the sha256 of the file.
+# Sheets are parsed in parallel on ASSOCIATION_MAP_PARSE_WORKERS processes (workbooks under
+# 1 MB, a single core or 1 worker parse inline), with the fastest installed engine and only
+# the columns the pipeline uses, and are kept as Arrow files under ASSOCIATION_MAP_CACHE_DIR
+# across restarts.
+@st.cache_resource
+def get_workbook_cache():
+    workers = int(os.environ.get("ASSOCIATION_MAP_PARSE_WORKERS", "0")) or None
+    reader = ExcelReader(sheet_columns=READ_COLUMNS, dtypes=READ_DTYPES)
+    return WorkbookCache(maxsize=8, loader=WorkbookLoader(workers=workers, reader=reader),
+                         disk_cache=get_disk_cache(reader.signature()))
 
-    # Validate columns in sheets
-    node_columns = ['Node Id', 'Name', 'Type', 'Relationship', 'SubType',
-                    'data_grid_title1', 'data_grid_info1', 'data_grid_title2', 'data_grid_info2',
-                    'data_grid_title3', 'data_grid_info3', 'data_grid_title4', 'data_grid_info4',
-                    'data_grid_title5', 'data_grid_info5']
 
-    connections_columns = ['UId', 'from', 'to', 'Level']
+# Template workbooks read in full (e.g. Project names.xlsx), also backed by the disk cache.
+# They are only read again when their mtime or size changes
+@st.cache_resource
+def get_template_cache():
+    return WorkbookCache(maxsize=4, disk_cache=get_disk_cache(''))
 
-    node_com_columns = ['Component', 'node_image', 'node_color', 'node_label_font_alignment', 'node_label_font_color', 'node_label_font_background', 'node_label_font_size', 'node_shape', 'node_size', 'node_shadow']
-    edge_columns = ['L2', 'edge_width', 'edge_color', 'edge_length', 'edge_dashes', 'connection_type']
-    global_columns = ['client_name', 'logo_url', 'sidebar_short_logo', 'background_mode', 'legend_Target Entity', 'legend_Organisation', 'legend_Individual', 'legend_Observations']
 
-    if not all(col in nodes_df.columns for col in node_columns):
-        st.error("Missing columns in 'Node' sheet Association Map.")
-        return None
+def get_disk_cache(namespace):
+    directory = os.environ.get("ASSOCIATION_MAP_CACHE_DIR", ".sheet_cache")
+    max_bytes = int(os.environ.get("ASSOCIATION_MAP_CACHE_BYTES", str(1024 * 1024 * 1024)))
+    return SheetDiskCache(directory, max_bytes, namespace)
 
-    if not all(col in connections_df.columns for col in connections_columns):
-        st.error("Missing columns in 'Connections' sheet Association Map.")
-        return None
-    
-    if not all(col in node_com_df.columns for col in node_com_columns):
-        st.error("Missing columns in 'Nodes' sheet of Relationshipmap Features.")
-        return None
 
-    if not all(col in edge_df.columns for col in edge_columns):
-        st.error("Missing columns in 'Edge' sheet of Relationshipmap Features.")
-        return None
-    
-    if not all(col in global_df.columns for col in global_columns):
-        st.error("Missing columns in 'Global' sheet of Relationshipmap Features.")
-        return None
+# Finished JSON outputs keyed by both workbook hashes and the UI choices
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(max_bytes=512 * 1024 * 1024)
 
-    # Check for blank rows in both sheets
-    empty_rows = nodes_df[nodes_df.isnull().all(axis=1) | (nodes_df == '').all(axis=1)]
-    # Check if there are any empty rows
-    if len(empty_rows) > 0:
-        st.error("Empty rows in node sheet of Association Map")
-        return None
 
-    empty_rows = connections_df[connections_df.isnull().all(axis=1) | (connections_df == '').all(axis=1)]
-    # Check if there are any empty rows
-    if len(empty_rows) > 0:
-        st.error("Empty rows in Connection sheet of Association Map")
-        return None
+# Per-sheet and per-rule validation results keyed by sheet fingerprints, held within
+# ASSOCIATION_MAP_VALIDATION_BYTES
+@st.cache_resource
+def get_validation_cache():
+    max_bytes = int(os.environ.get("ASSOCIATION_MAP_VALIDATION_BYTES", str(256 * 1024 * 1024)))
+    return ValidationCache(maxsize=256, max_bytes=max_bytes)
 
-    empty_rows = node_com_df[node_com_df.isnull().all(axis=1) | (node_com_df == '').all(axis=1)]
-    # Check if there are any empty rows
-    if len(empty_rows) > 0:
-        st.error("Empty rows in nodes sheet of Relationshipmap Features")
-        return None
-    
-    empty_rows = edge_df[edge_df.isnull().all(axis=1) | (edge_df == '').all(axis=1)]
-    # Check if there are any empty rows
-    if len(empty_rows) > 0:
-        st.error("Empty rows in edge sheet of Relationshipmap Features")
-        return None
-    
-    empty_rows = global_df[global_df.isnull().all(axis=1) | (global_df == '').all(axis=1)]
-    # Check if there are any empty rows
-    if len(empty_rows) > 0:
-        st.error("Empty rows in global sheet of Relationshipmap Features")
-        return None
-    
 
-    # Validate datatypes using pd.to_numeric and pd.to_datetime
-    node_datatypes = {'Node Id': 'int', 'Name': 'string', 'Type': 'string', 'Relationship': 'string',
-                      'SubType': 'string', 'data_grid_title1': 'string', 'data_grid_info1': 'string',
-                      'data_grid_title2': 'string', 'data_grid_info2': 'string',
-                      'data_grid_title3': 'string', 'data_grid_info3': 'string',
-                      'data_grid_title4': 'string', 'data_grid_info4': 'string',
-                      'data_grid_title5': 'string', 'data_grid_info5': 'string'}
+# Node, edge and legend style lookups compiled once per features template and shared by
+# every session using it; keyed by the template's sha256 (_map_feature is not hashed)
+@st.cache_resource(max_entries=16)
+def get_style_tables(digest, _map_feature):
+    return StyleTables.compile(_map_feature, digest)
 
-    connections_datatypes = {'UId': 'string', 'from': 'int', 'to': 'int', 'Level': 'string'}
 
-    node_com_datatypes = {'Component': 'string', 'node_image': 'string', 'node_color': 'string', 'node_label_font_alignment': 'string', 'node_label_font_color': 'string', 'node_label_font_background': 'string', 'node_label_font_size': 'int', 'node_shape': 'string', 'node_size': 'int', 'node_shadow':'int'}
-    edge_datatypes = {'L2': 'string', 'edge_width': 'int', 'edge_color': 'string', 'edge_length': 'int', 'edge_dashes': 'int', 'connection_type': 'string'}
-    global_datatypes = {'client_name': 'string', 'logo_url': 'string', 'sidebar_short_logo': 'string', 'background_mode': 'string', 'legend_Target Entity': 'string', 'legend_Organisation': 'string', 'legend_Individual': 'string', 'legend_Observations': 'string'}
-    
-    try:
-        nodes_df = nodes_df.astype(node_datatypes)
-    except ValueError as e:
-        st.error(f"Invalid datatypes in 'Node' sheet: {e}")
-        return None
+# Latest revision of each project's map, so a re-upload only rebuilds the rows that changed;
+# held within ASSOCIATION_MAP_REVISION_BYTES
+@st.cache_resource
+def get_revision_store():
+    max_bytes = int(os.environ.get("ASSOCIATION_MAP_REVISION_BYTES", str(256 * 1024 * 1024)))
+    return RevisionStore(maxsize=32, max_bytes=max_bytes)
 
-    try:
-        connections_df = connections_df.astype(connections_datatypes)
-    except ValueError as e:
-        st.error(f"Invalid datatypes in 'Connections' sheet: {e}")
-        return None
 
-    try:
-        node_com_df = node_com_df.astype(node_com_datatypes)
-    except ValueError as e:
-        st.error(f"Invalid datatypes in 'Nodes' sheet: {e}")
-        return None
+def load_workbook(source, run=NULL_RUN):
+    bundles = load_workbooks([source], run)
+    return None if bundles is None else bundles[0]
 
-    try:
-        edge_df = edge_df.astype(edge_datatypes)
-    except ValueError as e:
-        st.error(f"Invalid datatypes in 'Edge' sheet: {e}")
-        return None
 
+# Several workbooks in one go, so the ones not cached yet are parsed together
+def load_workbooks(sources, run=NULL_RUN):
     try:
-        global_df = global_df.astype(global_datatypes)
-    except ValueError as e:
-        st.error(f"Invalid datatypes in 'Global' sheet: {e}")
-        return None
-  
-
-    # Logical validation rules
-    # Rule 1: Node ID should be distinct in Node sheet
-    if not nodes_df['Node Id'].is_unique:
-        st.error("Duplicate Node IDs found in Node sheet.")
-        return None
-
-    # Rule 2: Node Id should exist in Node sheet for all the ids present in 'From' and 'To' of Connections sheet
-    connection_node_ids = set(connections_df['from'].tolist() + connections_df['to'].tolist())
-    if not set(nodes_df['Node Id']).issuperset(connection_node_ids):
-        st.error("Node IDs in Connections not found in Node.")
+        with run.stage('parse') as record:
+            bundles = get_workbook_cache().get_many(sources)
+            record['rows_out'] = sum(sheet_rows(bundle) for bundle in bundles)
+        return bundles
+    except FileNotFoundError:
+        st.error("File not found. Please upload a valid Excel file.")
         return None
-
-    # Rule 3: Level in Connections should be present in the L2 column of Edge
-    # sheet in relationshipmapfeatures excel file
-    edge_default_sheet = pd.read_excel(xls_RM, 'Edge')
-    if not connections_df['Level'].isin(edge_default_sheet['L2']).all():
-        st.error("Level in Sample Format - Connections should be present in the L2 column of Edge - Default sheet.")
+    except Exception as e:
+        st.error(f"Could not read Excel file: {e}")
         return None
 
 
-    # Rule 4: In Connections for all values in 'From' column, there should be a value in 'To' column
-    missing_to_values = connections_df[connections_df['from'].isin(nodes_df['Node Id']) & connections_df['to'].isna()]
-    if not missing_to_values.empty:
-        st.error("In Sample Format - Connections, missing 'To' values for some 'From' values.")
-        return None
-
-    # If all logical validations pass, return the validated dataframes
-    return nodes_df, connections_df, node_com_df, edge_df, global_df
+# Validation function: runs every rule for the chosen mode and shows all violations at once
+def validate_excel(bundle_AM, bundle_RM, mode):
+    report = validate_workbooks(bundle_AM.sheets, bundle_RM.sheets, mode, get_validation_cache())
+    for v in report.violations:
+        rows = v['rows']
+        if rows:
+            shown = ', '.join(str(row) for row in rows[:20])
+            more = f" and {len(rows) - 20} more" if len(rows) > 20 else ""
+            st.error(f"{v['message']} (sheet '{v['sheet']}', rows {shown}{more})")
+        else:
+            st.error(v['message'])
+
+    if not report.is_valid():
+        return None
+    return report.validated_data()
+
+
+PAGE_SIZES = [25, 100, 500]
+
+
+# Previews send one page, the head or a sample of a frame to the browser; every row is
+# only rendered when 'All rows' is picked
+def preview_frame(label, df, key):
+    st.write(f"{label} ({len(df)} rows)")
+    view = st.radio("View", ['Head', 'Page', 'Sample', 'All rows'], horizontal=True, key=f"{key}_view")
+    if view == 'Page':
+        size = st.selectbox("Rows per page", PAGE_SIZES, key=f"{key}_size")
+        pages = max(1, -(-len(df) // size))
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, key=f"{key}_page")
+        st.dataframe(df.iloc[(page - 1) * size:page * size])
+    elif view == 'Sample':
+        st.dataframe(df.sample(min(len(df), PAGE_SIZES[0]), random_state=0))
+    elif view == 'All rows':
+        st.dataframe(df)
+    else:
+        st.dataframe(df.head(PAGE_SIZES[0]))
+
+
+def show_summary(validated_data):
+    node_df, connection_df = validated_data[0], validated_data[1]
+    total_nodes, total_connections = st.columns(2)
+    total_nodes.metric("Nodes", len(node_df))
+    total_connections.metric("Connections", len(connection_df))
+    by_type, by_subtype, by_level = st.columns(3)
+    by_type.dataframe(node_df['Type'].value_counts())
+    by_subtype.dataframe(node_df['SubType'].value_counts())
+    by_level.dataframe(connection_df['Level'].value_counts())
+
+
+# The JSON is only parsed and sent once asked for: the header, then the node and
+# connection arrays a page at a time
+def preview_json(result):
+    if not st.checkbox("Show generated JSON", key="show_json"):
+        return
+    outline = result.outline()
+    st.json(outline['header'], expanded=False)
+    for section, count in outline['counts'].items():
+        size = st.selectbox(f"{section} per page", PAGE_SIZES, key=f"json_{section}_size")
+        pages = max(1, -(-count // size))
+        page = st.number_input(f"{section} page (of {pages}, {count} records)", min_value=1, max_value=pages, value=1,
+                               key=f"json_{section}_page")
+        st.json(result.records(section, (page - 1) * size, page * size), expanded=False)
+    if st.checkbox(f"Render the full JSON ({len(result.json_bytes)} bytes)", key="show_full_json"):
+        st.json(result.document())
+
+
+# Sharded download for maps too big for the viewer to parse in one go; built only when asked for.
+# node_df is the Node sheet as read, like the batch converter passes it
+def sharded_download(result, node_df):
+    by = st.selectbox("Split the map by", PARTITIONS, key="shard_by")
+    max_nodes = int(st.number_input("Nodes per shard", min_value=100, value=10000, step=1000, key="shard_max_nodes"))
+    if not st.checkbox("Prepare sharded download", key="shard_prepare"):
+        return
+    encoder = JsonStreamEncoder(compact=True, backend=JSON_BACKEND)
+    sharded = result.export(('shards', by, max_nodes),
+                            lambda: shard_document(result.document(), node_df, by, max_nodes, encoder))
+    manifest = sharded.manifest
+    st.caption(f"{len(manifest['shards'])} shards, {len(manifest['cross_shard_edges'])} connections between shards")
+    st.download_button(
+        "Download shards (zip)",
+        result.export(('shards_zip', by, max_nodes), sharded.to_zip),
+        key="download_shards_button",
+        file_name="output.shards.zip"
+    )
+
+
+# Binary and precompressed downloads, encoded once per result when first selected
+def encoded_download(result):
+    name = st.selectbox("Other encodings", [''] + [name for name in export_encodings() if name != 'json'], key="export_encoding")
+    if not name:
+        return
+    data, stats = result.encoded(name)
+    st.caption(f"{stats['bytes']} bytes ({stats['ratio']}x smaller than JSON), encoded in {stats['encode_seconds']:.3f}s, "
+               f"decodes in {stats['decode_seconds']:.3f}s")
+    st.download_button(
+        f"Download {name}",
+        data,
+        key="download_encoded_button",
+        file_name="output" + EXPORT_ENCODINGS[name].extension,
+        mime=EXPORT_ENCODINGS[name].mime
+    )
+
+
+# Format 2 download (styles written once and referred to by id), re-encoded from the
+# format 1 document only when asked for
+def compact_download(result):
+    if not st.checkbox("Prepare compact download (format 2)", key="v2_prepare"):
+        return
+    def make():
+        document = result.document()
+        header = {key: value for key, value in document.items() if key != 'default'}
+        return encode_v2(JsonStreamEncoder(compact=True, backend=JSON_BACKEND), header, document['default']['node'],
+                         document['default']['node_connections'])
+    json_bytes = result.export(('v2',), make)
+    st.caption(f"{len(json_bytes)} bytes against {len(result.json_bytes)} for format 1")
+    st.download_button(
+        "Download compact JSON",
+        json_bytes,
+        key="download_v2_button",
+        file_name="output.v2.json"
+    )
 
 
 # function to validate and upload excel sheet and generate JSON output 
@@ -384,32 +298,38 @@ def code(project):
 
     uploaded_file_AM = st.file_uploader("Upload Association Map Excel File", type=["xlsx", "xls"])
     all_filled = False
+    run = get_metrics().run(project=project)
 
     if uploaded_file_AM is not None:
+        # parsed alongside the features template the 'Default' and 'Fill from UI' modes read
+        bundles = load_workbooks([uploaded_file_AM, FEATURES_TEMPLATE], run)
+        if bundles is None:
+            return
+        bundle_AM = bundles[0]
+        if "Node" not in bundle_AM.sheet_names:
+            st.error("Missing required sheets. Please include 'Node' and 'Connections' in Association Map Excel File.")
+            return
 
         choice1 = st.selectbox('Default/Upload excelfile/fill through UI', [''] + ['Default', 'Upload excelfile', 'Fill from UI'])  
         if choice1 == 'Default':
-            uploaded_file_RM = 'Relationshipmap Features Template.xlsx'
+            uploaded_file_RM = FEATURES_TEMPLATE
             all_filled = True
-            xls_AM = pd.ExcelFile(uploaded_file_AM)
-            nodes_df = pd.read_excel(xls_AM, "Node")
+            nodes_df = bundle_AM["Node"]
             distinct_values = nodes_df['SubType'].unique().tolist()
         elif choice1 == 'Upload excelfile':
             uploaded_file_RM = st.file_uploader("Upload Relationshipmap Features Excel file", type=["xlsx", "xls"])
             if uploaded_file_RM is not None:
                 all_filled = True
-                xls_AM = pd.ExcelFile(uploaded_file_AM)
-                nodes_df = pd.read_excel(xls_AM, "Node")
+                nodes_df = bundle_AM["Node"]
                 distinct_values = nodes_df['SubType'].unique().tolist()
         elif choice1 == 'Fill from UI':
-            uploaded_file_RM = 'Relationshipmap Features Template.xlsx'  
-            dict1 = {'White Hexagon': 'https://association-map-cdn-public.s3.us-west-1.amazonaws.com/DragnetAlpha/AssociationMap/Stories2.png', 'Pink Hexagon': 'https://association-map-cdn-public.s3-us-west-1.amazonaws.com/DragnetAlpha/AssociationMap/Stories1.png', 'Blue Hexagon':'https://association-map-cdn-public.s3.us-west-1.amazonaws.com/DragnetAlpha/AssociationMap/Target+Entity+1.png', 'Sky Blue Circle':'https://association-map-cdn-public.s3-us-west-1.amazonaws.com/DragnetAlpha/AssociationMap/Entity.png', 'Violet Hexagon': 'https://association-map-cdn-public.s3.us-west-1.amazonaws.com/DragnetAlpha/AssociationMap/Target+Entity+3.png'}
-            xls_AM = pd.ExcelFile(uploaded_file_AM)
-            nodes_df = pd.read_excel(xls_AM, "Node")
+            uploaded_file_RM = FEATURES_TEMPLATE  
+            dict1 = SHAPE_IMAGES
+            nodes_df = bundle_AM["Node"]
             distinct_values = nodes_df['SubType'].unique().tolist()
             d = {}
             distinct_values2 = nodes_df['SubType'].unique().tolist()
-            original_options = ['White Hexagon', 'Pink Hexagon', 'Blue Hexagon', 'Sky Blue Circle', 'Violet Hexagon']
+            original_options = list(SHAPE_IMAGES)
             options_len = original_options.copy()
 
             lsize = len(distinct_values)
@@ -427,78 +347,82 @@ def code(project):
 
     if uploaded_file_AM is not None and all_filled:
         st.markdown("### Validating Excel File...")
-        if choice1 == 'Fill from UI':
-            validated_data = validate_excel(uploaded_file_AM, uploaded_file_RM)
-        else:
-            validated_data = validate_excel1(uploaded_file_AM, uploaded_file_RM)
-
-        if validated_data is not None:
-            st.success("Validation successful!")
-
-            st.write("Nodes DataFrame:")
-            st.write(validated_data[0])
-
-            st.write("Connections DataFrame:")
-            st.write(validated_data[1])
-
-            st.write("Nodes DataFrame:")
-            st.write(validated_data[2])
-
-            st.write("Edge DataFrame:")
-            st.write(validated_data[3])
-
-            st.write("Global DataFrame:")
-            st.write(validated_data[4])
-                
-            node_df = pd.read_excel(uploaded_file_AM, 'Node')
-            connection_df = pd.read_excel(uploaded_file_AM, 'Connections')
-            map_feature = pd.read_excel(uploaded_file_RM, sheet_name=None)
-
+        bundle_RM = load_workbook(uploaded_file_RM, run)
+        if bundle_RM is None:
+            return
 
-            if choice1 == 'Fill from UI':
-                node_processor = NodeProcessor(node_df, map_feature, connection_df, d, dict1)
-                nodes = node_processor.process_node_data(node_df, map_feature, connection_df, d, dict1)
-            else:
-                node_processor = NodeProcessor1(node_df, map_feature, connection_df)
-                nodes = node_processor.process_node_data(node_df, map_feature, connection_df)
-
-            connection_processor = ConnectionProcessor(node_df, map_feature, connection_df)
-            connections = connection_processor.process_connection_data()
-
-        
-            global_df_ = map_feature['Global']
-            nodes_df_ = map_feature['Nodes']
-            if choice1 == 'Fill from UI':
-                legend_data = GlobalProcessor.process_global_data(dict1, distinct_values, d)
+        if choice1 != 'Fill from UI':
+            d = {}
+            dict1 = {}
+        index = st.checkbox("Embed search and filter indexes in the JSON", key="embed_index")
+        key = (bundle_AM.digest, bundle_RM.digest, choice1, tuple(sorted(d.items())), project, index)
+        result_cache = get_result_cache()
+        result = result_cache.get(key)
+        cache_hit = result is not None
+        revisions = get_revision_store()
+        previous = revisions.get(project)
+        context = revision_context(bundle_AM, bundle_RM, choice1, d)
+        if cache_hit and (previous is None or previous.origin != key):
+            # the project's latest map is the cached one again, so the next upload is diffed against it
+            revisions.put(project, RevisionBase(context, result, bundle_AM, bundle_RM, key))
+
+        if not cache_hit:
+            with run.stage('validate', rows_in=sheet_rows(bundle_AM) + sheet_rows(bundle_RM)) as record:
+                validated_data = validate_excel(bundle_AM, bundle_RM, choice1)
+                record['rows_out'] = 0 if validated_data is None else sum(len(df) for df in validated_data)
+            if validated_data is None:
+                run.finish()
+                return
+
+            encoder = JsonStreamEncoder(backend=JSON_BACKEND)
+            styles = get_style_tables(bundle_RM.digest, bundle_RM.sheets)
+            if previous is None or previous.context != context:
+                # nothing to reuse: the streaming build, with the revision left for a re-upload to make
+                json_bytes = generate_json(bundle_AM, bundle_RM, choice1, d, dict1, distinct_values, encoder, run, index, styles)
+                result = result_cache.put(key, JsonResult(json_bytes, validated_data))
+                revisions.put(project, RevisionBase(context, result, bundle_AM, bundle_RM, key))
             else:
-                legend_data = GlobalProcessor1.process_global_data(nodes_df_, distinct_values)
-
-            
-            nodes_data_ = nodes_df_.to_dict(orient='records')
-
-            edges_df_ = map_feature['Edge']
-            edges_data_ = edges_df_.to_dict(orient='records')
-
-            json_generator = JsonGenerator(legend_data, global_df_['client_name'].values[0], global_df_['logo_url'].values[0], global_df_['sidebar_short_logo'].values[0], nodes, connections, nodes_df_, global_df_, map_feature, node_df)
-            json_output = json_generator.create_json_output(legend_data, global_df_['client_name'].values[0], global_df_['logo_url'].values[0], global_df_['sidebar_short_logo'].values[0], nodes, connections, nodes_df_, global_df_, map_feature, node_df)
-
-            json_output_str = json.dumps(json_output, indent=2)
-
-            st.subheader("Generated JSON:")
-            st.json(json_output)
+                regeneration = regenerate(bundle_AM, bundle_RM, choice1, d, dict1, distinct_values, previous, encoder, run, index, styles)
+                regeneration.revision.origin = key
+                revisions.put(project, regeneration.revision)
+                patch_bytes = None if regeneration.patch is None else encoder.dumps(regeneration.patch)
+                result = result_cache.put(key, JsonResult(regeneration.json_bytes, validated_data, patch_bytes, regeneration.stats))
+            run.finish()
+            st.session_state.pipeline_run = run
+
+            save_json(result.json_bytes, project)
+
+        st.caption(f"Result cache: {'hit' if cache_hit else 'miss'} ({result_cache.hits} hits, {result_cache.misses} misses)")
+        st.success("Validation successful!")
+        validated_data = result.validated_data
+
+        show_summary(validated_data)
+        labels = ["Nodes DataFrame", "Connections DataFrame", "Nodes DataFrame", "Edge DataFrame", "Global DataFrame"]
+        for label, sheet, df in zip(labels, SHEET_SCHEMAS, validated_data):
+            preview_frame(label, df, sheet)
+
+        st.subheader("Generated JSON:")
+        preview_json(result)
+        st.download_button(
+            "Download JSON",
+            result.json_bytes,
+            key="download_button",
+            file_name="output.json"
+        )
+        if result.patch_bytes is not None:
+            stats = result.stats
+            st.caption(f"{'Incremental' if stats['incremental'] else 'Full'} rebuild: {stats['nodes_rebuilt']} of {stats['nodes']} nodes "
+                       f"and {stats['edges_rebuilt']} of {stats['edges']} connections rebuilt, {stats['patch_ops']} patch operations")
             st.download_button(
-                "Download JSON",
-                json_output_str,  
-                key="download_button",
-                file_name="output.json" 
+                "Download JSON Patch",
+                result.patch_bytes,
+                key="download_patch_button",
+                file_name="output.patch.json"
             )
-
-            json_string = json.dumps(json_output)
-
-            # inserting JSON into the database
-            var = f"INSERT INTO json_store (AssociationMapJSON, AppName) VALUES ('{json_string}', '{project}')"
-            run_query(var)
-            
+        encoded_download(result)
+        compact_download(result)
+        sharded_download(result, bundle_AM['Node'])
+        show_save_status()
 
 
 #function for downloading excel template
@@ -514,10 +438,6 @@ def download():
     if st.button(button_text_RM):
         st.markdown(f"[{button_text_RM}]({link_url_RM})")
 
-if not firebase_admin._apps:
-    cred = credentials.Certificate('login-f7584-3a8c6c70f3a2.json')
-    firebase_admin.initialize_app(cred)
-
 st.set_page_config(page_title="Association Map", layout="wide")
 
 
@@ -531,7 +451,7 @@ def main():
 
     def f():
         try:
-            user = auth.get_user_by_email(email)
+            user = get_firebase_auth().get_user_by_email(email)
             st.write('Login Successful')
             st.session_state.username = user.uid
             st.session_state.useremail = user.email
@@ -567,7 +487,7 @@ def main():
             username = st.text_input('Enter your unique username')
 
             if st.button('Create my account'):
-                user = auth.create_user(email=email, password=password, uid=username)
+                user = get_firebase_auth().create_user(email=email, password=password, uid=username)
 
                 st.success('Account created successfully!')
                 st.markdown('Please Login using your email and password')
@@ -579,12 +499,13 @@ def main():
 
         #selecting the project part
         st.title("Choose a project")
-        projects = pd.read_excel('Project names.xlsx', "Project")
+        projects = get_template_cache().get('Project names.xlsx')['Project']
         selected_option = projects['Project Names'].unique().tolist()
         project = st.selectbox('Choose a project', [''] + selected_option)
         st.write(f"You selected: {project}")
         download()
         code(project)
+        show_metrics_panel()
         
 if __name__ == "__main__":
     main()
\ No newline at end of file
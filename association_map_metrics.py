@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger('association_map.metrics')
+
+# upper bounds in seconds of the stage duration histogram
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def peak_rss():
+    # peak resident set size of the process in bytes (ru_maxrss is kilobytes on Linux)
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss():
+    # resident set size of the process now in bytes; None where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class RssSampler:
+    # how far the current RSS rose above its value at start() before stop(), sampled from
+    # /proc/self/statm every interval seconds on a background thread. The thread needs the
+    # GIL, so a spike inside one long C call can be missed. Without /proc it falls back to
+    # the growth of the lifetime peak RSS, which only shows stages that raise that peak.
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.done = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.base = current_rss()
+        if self.base is None:
+            self.base = peak_rss()
+            return
+        self.peak = self.base
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+        self.thread.start()
+
+    def watch(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, current_rss() or 0)
+
+    def stop(self):
+        if self.thread is None:
+            return max(peak_rss() - self.base, 0)
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, current_rss() or 0)
+        return self.peak - self.base
+
+
+class StageTotals:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.peak_memory = 0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, record):
+        self.count += 1
+        self.seconds += record['seconds']
+        self.max_seconds = max(self.max_seconds, record['seconds'])
+        self.rows_in += record['rows_in'] or 0
+        self.rows_out += record['rows_out'] or 0
+        self.peak_memory = max(self.peak_memory, record['memory_bytes'] or 0)
+        for i, bound in enumerate(BUCKETS):
+            if record['seconds'] <= bound:
+                self.buckets[i] += 1
+
+
+class PipelineMetrics:
+    # process-wide totals per pipeline stage. Each generation records its stages on a
+    # PipelineRun from run(); finished stages are added here, logged as one JSON line on
+    # the 'association_map.metrics' logger and, with textfile set, written out in the
+    # Prometheus text format for node_exporter's textfile collector. When disabled, run()
+    # returns NULL_RUN and nothing is measured. trace_memory measures each stage's peak
+    # allocation with tracemalloc (process-wide, so approximate with concurrent sessions);
+    # without it the stage's peak RSS growth over its starting RSS is recorded instead
+    # (RssSampler).
+    def __init__(self, enabled=True, trace_memory=False, textfile=None):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.textfile = textfile
+        self.totals = {}
+        self.lock = threading.Lock()
+        if enabled and trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def from_env(environ=os.environ):
+        # ASSOCIATION_MAP_METRICS=1 turns metrics on, ASSOCIATION_MAP_TRACE_MEMORY=1 adds
+        # tracemalloc, ASSOCIATION_MAP_METRICS_FILE is the Prometheus text file
+        return PipelineMetrics(enabled=environ.get('ASSOCIATION_MAP_METRICS', '') not in ('', '0'),
+                               trace_memory=environ.get('ASSOCIATION_MAP_TRACE_MEMORY', '') not in ('', '0'),
+                               textfile=environ.get('ASSOCIATION_MAP_METRICS_FILE') or None)
+
+    def run(self, **labels):
+        if not self.enabled:
+            return NULL_RUN
+        return PipelineRun(self, labels)
+
+    def record(self, record, labels):
+        with self.lock:
+            self.totals.setdefault(record['stage'], StageTotals()).add(record)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(dict(labels, **record), default=str))
+
+    def summary(self):
+        # one row per stage for display
+        with self.lock:
+            return [{'stage': stage, 'runs': t.count, 'total_seconds': round(t.seconds, 4),
+                     'mean_seconds': round(t.seconds / t.count, 4), 'max_seconds': round(t.max_seconds, 4),
+                     'rows_in': t.rows_in, 'rows_out': t.rows_out, 'peak_memory_bytes': t.peak_memory}
+                    for stage, t in self.totals.items()]
+
+    def prometheus_text(self):
+        lines = [
+            '# HELP association_map_stage_duration_seconds Wall time of each pipeline stage.',
+            '# TYPE association_map_stage_duration_seconds histogram',
+        ]
+        with self.lock:
+            totals = list(self.totals.items())
+        for stage, t in totals:
+            for bound, count in zip(BUCKETS, t.buckets):
+                lines.append(f'association_map_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'association_map_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {t.count}')
+            lines.append(f'association_map_stage_duration_seconds_sum{{stage="{stage}"}} {t.seconds}')
+            lines.append(f'association_map_stage_duration_seconds_count{{stage="{stage}"}} {t.count}')
+        for name, attr, kind, help_text in (
+                ('association_map_stage_rows_in_total', 'rows_in', 'counter', 'Rows read by each pipeline stage.'),
+                ('association_map_stage_rows_out_total', 'rows_out', 'counter', 'Rows produced by each pipeline stage.'),
+                ('association_map_stage_peak_memory_bytes', 'peak_memory', 'gauge', 'Largest memory growth seen in one run of each stage.')):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for stage, t in totals:
+                lines.append(f'{name}{{stage="{stage}"}} {getattr(t, attr)}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path=None):
+        # written to a temporary file and renamed so the collector never reads half a file
+        path = path or self.textfile
+        if path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class Stage:
+    def __init__(self, run, name, rows_in, exclude):
+        self.run = run
+        self.exclude = exclude
+        self.record = {'stage': name, 'seconds': 0.0, 'rows_in': rows_in, 'rows_out': None, 'memory_bytes': None}
+
+    def __enter__(self):
+        if self.run.metrics.trace_memory:
+            tracemalloc.reset_peak()
+            self.memory_start = tracemalloc.get_traced_memory()[0]
+        else:
+            self.sampler = RssSampler()
+            self.sampler.start()
+        self.first_nested = len(self.run.stages)
+        self.start = time.perf_counter()
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record['seconds'] = time.perf_counter() - self.start
+        # lazy stages consumed inside this one are reported on their own
+        nested = [r for r in self.run.stages[self.first_nested:] if r['stage'] in self.exclude]
+        self.record['seconds'] -= sum(r['seconds'] for r in nested)
+        if self.run.metrics.trace_memory:
+            self.record['memory_bytes'] = max(tracemalloc.get_traced_memory()[1] - self.memory_start, 0)
+        else:
+            self.record['memory_bytes'] = self.sampler.stop()
+        if exc_type is not None:
+            self.record['error'] = exc_type.__name__
+        self.run.add(self.record)
+        return False
+
+
+class PipelineRun:
+    # the stages of one generation. stage() is a context manager yielding the stage's
+    # record, on which the caller sets 'rows_out'; timed_iter() measures a lazy stage by
+    # the time spent producing each item, counting the items as rows out. A stage that
+    # drives lazy stages names them in exclude so their time is not counted twice.
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+        self.stages = []
+
+    def stage(self, name, rows_in=None, exclude=()):
+        return Stage(self, name, rows_in, exclude)
+
+    def timed_iter(self, name, iterable, rows_in=None):
+        record = {'stage': name, 'seconds': 0.0, 'rows_in': rows_in, 'rows_out': 0, 'memory_bytes': None}
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                record['seconds'] += time.perf_counter() - start
+                break
+            record['seconds'] += time.perf_counter() - start
+            record['rows_out'] += 1
+            yield item
+        self.add(record)
+
+    def add(self, record):
+        self.stages.append(record)
+        self.metrics.record(record, self.labels)
+
+    def finish(self):
+        self.metrics.write_textfile()
+
+
+class NullStage:
+    def __init__(self):
+        self.record = {}
+
+    def __enter__(self):
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class NullRun:
+    # stand-in for PipelineRun when metrics are disabled
+    stages = ()
+
+    def __init__(self):
+        self.null_stage = NullStage()
+
+    def stage(self, name, rows_in=None, exclude=()):
+        return self.null_stage
+
+    def timed_iter(self, name, iterable, rows_in=None):
+        return iterable
+
+    def finish(self):
+        pass
+
+
+NULL_RUN = NullRun()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import hashlib
+import io
+import os
+import zipfile
+
+import pandas as pd
+
+from association_map_utils import JsonStreamEncoder
+
+PARTITIONS = ('component', 'Type', 'SubType')
+
+
+def connected_components(node_ids, connections):
+    # Node Id -> representative of its connected component (union-find with path halving)
+    parent = {uid: uid for uid in node_ids}
+
+    def find(uid):
+        while parent[uid] != uid:
+            parent[uid] = parent[parent[uid]]
+            uid = parent[uid]
+        return uid
+
+    for edge in connections:
+        if edge['from'] in parent and edge['to'] in parent:
+            a, b = find(edge['from']), find(edge['to'])
+            if a != b:
+                parent[b] = a
+    return {uid: find(uid) for uid in node_ids}
+
+
+def pack(groups, max_nodes):
+    # groups (key -> node count) packed largest first into shards of at most max_nodes
+    # nodes; a group bigger than max_nodes gets a shard of its own. Returns key -> shard
+    shards = []
+    assignment = {}
+    for key, size in sorted(groups.items(), key=lambda item: -item[1]):
+        for index, used in enumerate(shards):
+            if used + size <= max_nodes:
+                shards[index] += size
+                assignment[key] = index
+                break
+        else:
+            assignment[key] = len(shards)
+            shards.append(size)
+    return assignment
+
+
+def partition(nodes, connections, node_df, by='component', max_nodes=10000):
+    # Node Id -> shard number, and each shard's label. Components are packed together up
+    # to max_nodes; Type and SubType give one shard per value
+    if by not in PARTITIONS:
+        raise ValueError(f"Unknown partition: {by}")
+    node_ids = [node['UID'] for node in nodes]
+    if by == 'component':
+        groups = connected_components(node_ids, connections)
+        sizes = {}
+        for root in groups.values():
+            sizes[root] = sizes.get(root, 0) + 1
+        shard_of_group = pack(sizes, max_nodes)
+        labels = {}
+        for root, shard in shard_of_group.items():
+            labels.setdefault(shard, []).append(root)
+        labels = {shard: f"{len(roots)} components" for shard, roots in labels.items()}
+    else:
+        # blank cells (NaN or pd.NA) share one shard
+        values = {uid: None if pd.isna(value) else value for uid, value in zip(node_df['Node Id'].tolist(), node_df[by].tolist())}
+        groups = {uid: values.get(uid) for uid in node_ids}
+        shard_of_group = {value: index for index, value in enumerate(dict.fromkeys(groups.values()))}
+        labels = {index: str(value) for value, index in shard_of_group.items()}
+    return {uid: shard_of_group[group] for uid, group in groups.items()}, labels
+
+
+class ShardedMap:
+    # a map split into shard documents plus a manifest. Each shard is
+    # {"shard": n, "default": {"node": [...], "node_connections": [...]}}; an edge is
+    # written to the shard of its 'from' node, and edges whose 'to' node is in another
+    # shard are listed in the manifest's cross_shard_edges. The manifest carries every
+    # top level key of the full document, so the viewer can draw the legend and filters
+    # before loading any shard.
+    def __init__(self, manifest, files):
+        self.manifest = manifest
+        self.files = files
+
+    def to_zip(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, data in self.files.items():
+                archive.writestr(name, data)
+        return buffer.getvalue()
+
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name, data in self.files.items():
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(data)
+
+    def rows(self, project):
+        # (json_bytes, app_name) pairs for JsonStore.save_many, one row per file
+        return [(data, f"{project}/{name}") for name, data in self.files.items()]
+
+
+def shard_map(header, nodes, connections, node_df, by='component', max_nodes=10000, encoder=None):
+    if encoder is None:
+        encoder = JsonStreamEncoder()
+    shard_of, labels = partition(nodes, connections, node_df, by, max_nodes)
+    shard_nodes = {shard: [] for shard in labels}
+    shard_edges = {shard: [] for shard in labels}
+    for node in nodes:
+        shard_nodes[shard_of[node['UID']]].append(node)
+    cross = []
+    for edge in connections:
+        source, target = shard_of.get(edge['from']), shard_of.get(edge['to'])
+        # an edge whose 'from' node is not in the map (its SubType is missing from the
+        # template) is kept with its 'to' node, as the full document keeps it too
+        shard = source if source is not None else target if target is not None else min(labels, default=None)
+        if shard is None:
+            continue
+        shard_edges[shard].append(edge)
+        if target != source:
+            cross.append({'UID': edge['UID'], 'from': edge['from'], 'to': edge['to'], 'from_shard': source, 'to_shard': target})
+
+    files = {}
+    shards = []
+    for shard in sorted(labels):
+        name = f"shard-{shard:04d}.json"
+        data = encoder.encode({'shard': shard}, shard_nodes[shard], shard_edges[shard])
+        files[name] = data
+        shards.append({'shard': shard, 'file': name, 'label': labels[shard], 'nodes': len(shard_nodes[shard]),
+                       'connections': len(shard_edges[shard]), 'bytes': len(data), 'sha256': hashlib.sha256(data).hexdigest()})
+    manifest = dict(header, partition=by, nodes=len(nodes), connections=len(connections), shards=shards,
+                    cross_shard_edges=cross)
+    files = dict([('manifest.json', encoder.dumps(manifest))] + list(files.items()))
+    return ShardedMap(manifest, files)
+
+
+def shard_document(document, node_df, by='component', max_nodes=10000, encoder=None):
+    # shards an already generated document, e.g. JsonResult.load_json()
+    header = {key: value for key, value in document.items() if key != 'default'}
+    default = document['default']
+    return shard_map(header, default['node'], default['node_connections'], node_df, by, max_nodes, encoder)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import heapq
+import os
+import pickle
+import tempfile
+from io import BytesIO
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+from association_map_metrics import NULL_RUN
+from association_map_utils import (ExcelReader, JsonStreamEncoder, NodeProcessor, NodeProcessor1, build_header, build_legend,
+                                   style_edges)
+from association_map_validation import READ_DTYPES, SHEET_COLUMNS, check_chunk, merge_violations, validate_workbooks
+
+# Streaming mode for workbooks whose Connections sheet is too big to load whole. The sheet
+# is read in row chunks with openpyxl's read-only iter_rows; each chunk is validated
+# against the already validated Node and Edge sheets, resolved to styled edge records and
+# sorted. Sorted chunks are buffered up to a memory ceiling and spilled to temporary files
+# as runs, and the runs are merged straight into the JSON writer. Ties on 'from' keep
+# sheet order, which is the order a full in-memory build lists edges in, so the output
+# is the same document generate_json writes.
+
+
+def excel_value(value):
+    # a cell as pandas' openpyxl reader returns it: integral numbers as int, blanks as NaN
+    if value is None or value == '':
+        return np.nan
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def iter_sheet_chunks(source, sheet_name, columns, chunk_rows=50000):
+    # DataFrames of up to chunk_rows rows of one sheet holding the given columns (absent
+    # ones are left out, as ExcelReader's usecols does). The index counts data rows from 0
+    # across chunks, so violations name the same Excel rows as a full read; trailing blank
+    # rows are dropped like pandas does. A missing sheet yields a single None.
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        if sheet_name not in workbook.sheetnames:
+            yield None
+            return
+        rows = workbook[sheet_name].iter_rows(values_only=True)
+        positions = {}
+        for position, name in enumerate(next(rows, ())):
+            if name is not None and str(name) in columns:
+                positions.setdefault(str(name), position)
+        keep = sorted(positions, key=positions.get)
+        buffer = []
+        blank = 0
+        start = 0
+        for row in rows:
+            if all(cell is None or cell == '' for cell in row):
+                # only kept if a filled row follows
+                blank += 1
+                continue
+            buffer.extend([[np.nan] * len(keep)] * blank)
+            blank = 0
+            buffer.append([excel_value(row[positions[name]]) if positions[name] < len(row) else np.nan for name in keep])
+            if len(buffer) >= chunk_rows:
+                yield pd.DataFrame(buffer, columns=keep, index=pd.RangeIndex(start, start + len(buffer)))
+                start += len(buffer)
+                buffer = []
+        if buffer or start == 0:
+            yield pd.DataFrame(buffer, columns=keep, index=pd.RangeIndex(start, start + len(buffer)))
+    finally:
+        workbook.close()
+
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                block = pickle.load(f)
+            except EOFError:
+                return
+            yield from block.to_dict('records')
+
+
+def frame_records(frame, block_rows):
+    for start in range(0, frame.shape[0], block_rows):
+        yield from frame.iloc[start:start + block_rows].to_dict('records')
+
+
+class EdgeRuns:
+    # styled edge frames sorted by 'from', buffered until they pass half of max_memory
+    # bytes (the other half is room for sorting them) and then spilled to a temporary file
+    # as one sorted run of pickled blocks. records() merges the runs and the buffer, ties
+    # going to the earlier rows, and numbers the edges' UIDs in that order.
+    def __init__(self, max_memory=256 * 1024 * 1024, directory=None, block_rows=4096):
+        self.max_memory = max_memory
+        self.directory = directory
+        self.block_rows = block_rows
+        self.frames = []
+        self.buffered = 0
+        self.runs = []
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def add(self, frame):
+        self.frames.append(frame)
+        self.buffered += int(frame.memory_usage(deep=True).sum())
+        self.rows += len(frame)
+        if self.buffered > self.max_memory // 2:
+            self.spill()
+
+    def sorted_buffer(self):
+        # a stable sort keeps the chunks' sheet order for equal 'from' values
+        frame = pd.concat(self.frames, ignore_index=True).sort_values('from', kind='stable')
+        self.frames = []
+        self.buffered = 0
+        return frame
+
+    def spill(self):
+        frame = self.sorted_buffer()
+        fd, path = tempfile.mkstemp(suffix='.run', dir=self.directory)
+        self.runs.append(path)
+        with os.fdopen(fd, 'wb') as f:
+            for start in range(0, frame.shape[0], self.block_rows):
+                pickle.dump(frame.iloc[start:start + self.block_rows], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def records(self):
+        sources = [read_run(path) for path in self.runs]
+        if self.frames:
+            sources.append(frame_records(self.sorted_buffer(), self.block_rows))
+        for uid, record in enumerate(heapq.merge(*sources, key=lambda record: record['from']), 1):
+            record['UID'] = uid
+            yield record
+
+    def close(self):
+        for path in self.runs:
+            if os.path.exists(path):
+                os.unlink(path)
+        self.runs = []
+        self.frames = []
+
+
+def resolve_chunk(chunk, cast, node_ids, map_feature, styles=None):
+    # the styled edge records of one validated chunk, without UIDs
+    valid = cast['from'].isin(node_ids) & cast['to'].isin(node_ids)
+    df = pd.DataFrame({'from': cast['from'][valid].astype('int'), 'to': cast['to'][valid].astype('int'),
+                       'L2': chunk['Level'][valid].astype(str)}).reset_index(drop=True)
+    return style_edges(df, map_feature, styles)
+
+
+def stream_json(source_AM, bundle_RM, choice1, d, dict1, output, encoder=None, chunk_rows=50000, max_memory=256 * 1024 * 1024,
+                styles=None, run=NULL_RUN, temp_dir=None):
+    # validates the Association Map workbook at source_AM (a path or bytes) reading its
+    # Connections sheet in chunks and, when it is valid, writes the same JSON document as
+    # generate_json to the binary file output. Returns the ValidationReport; nothing is
+    # written when it has violations. max_memory bounds the buffered connection data.
+    map_feature = bundle_RM.sheets
+    reader = ExcelReader(sheet_columns={'Node': SHEET_COLUMNS['Node']}, dtypes={'Node': READ_DTYPES['Node']})
+    with run.stage('parse') as record:
+        workbook = reader.open(source_AM)
+        node_df = reader.read_sheet(workbook, 'Node') if 'Node' in workbook.sheet_names else None
+        record['rows_out'] = 0 if node_df is None else len(node_df)
+    sheets_AM = {} if node_df is None else {'Node': node_df}
+
+    with run.stage('validate') as record:
+        report = validate_workbooks(sheets_AM, map_feature, choice1, deferred=('Connections',))
+        record['rows_out'] = sum(len(df) for df in report.frames.values())
+
+    with EdgeRuns(max_memory, temp_dir) as runs:
+        with run.stage('connection_ingest') as record:
+            node_ids = report.frames['Node']['Node Id'] if 'Node' in report.frames else pd.Series([], dtype='int')
+            rows_in = 0
+            for chunk in iter_sheet_chunks(source_AM, 'Connections', SHEET_COLUMNS['Connections'], chunk_rows):
+                cast, violations = check_chunk('Connections', chunk, report.frames, choice1)
+                report.violations.extend(violations)
+                rows_in += 0 if chunk is None else len(chunk)
+                # after the first violation the rest of the sheet is only checked
+                if report.is_valid():
+                    runs.add(resolve_chunk(chunk, cast, node_ids, map_feature, styles))
+            record['rows_in'] = rows_in
+            record['rows_out'] = runs.rows
+            record['runs'] = len(runs.runs)
+        report.violations = merge_violations(report.violations)
+        if not report.is_valid():
+            return report
+
+        distinct_values = node_df['SubType'].unique().tolist()
+        with run.stage('node_build', rows_in=len(node_df)) as record:
+            if choice1 == 'Fill from UI':
+                nodes = NodeProcessor(node_df, map_feature, None, d, dict1, styles).process_node_data(node_df, map_feature, None, d, dict1)
+            else:
+                nodes = NodeProcessor1(node_df, map_feature, None, styles).process_node_data(node_df, map_feature, None)
+            record['rows_out'] = len(nodes)
+        with run.stage('legend', rows_in=len(distinct_values)) as record:
+            header = build_header(map_feature, node_df, build_legend(map_feature, choice1, d, dict1, distinct_values, styles))
+            record['rows_out'] = len(header['legend'])
+        if encoder is None:
+            encoder = JsonStreamEncoder()
+        with run.stage('json_encode', rows_in=len(nodes) + runs.rows):
+            encoder.write(output, header, nodes, runs.records())
+    return report
@@ -2,107 +2,728 @@
 # coding: utf-8
 
 import pandas as pd
+import numpy as np
 import json
 import ast
+import datetime
+import gzip
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+from association_map_metrics import NULL_RUN
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+class ExcelReader:
+    # reads workbooks with the fastest installed engine. engine='auto' uses calamine when
+    # python-calamine is installed and pandas' default otherwise (openpyxl, which pandas
+    # already opens in read-only streaming mode). sheet_columns maps a sheet name to the
+    # only columns to load (None loads every column); when it is given, sheets not listed
+    # are skipped. dtypes maps a
+    # sheet name to dtype hints applied while reading.
+    def __init__(self, engine='auto', sheet_columns=None, dtypes=None):
+        self.engine = ExcelReader.resolve_engine(engine)
+        self.sheet_columns = sheet_columns
+        self.dtypes = dtypes or {}
+
+    def resolve_engine(engine):
+        if engine == 'auto':
+            return 'calamine' if importlib.util.find_spec('python_calamine') is not None else None
+        if engine == 'calamine' and importlib.util.find_spec('python_calamine') is None:
+            return None
+        return engine
+
+    def signature(self):
+        # identifies the settings that change the parsed frames, for on-disk cache keys
+        return repr((self.sheet_columns, sorted((sheet, sorted((col, str(dtype)) for col, dtype in dtypes.items()))
+                                                for sheet, dtypes in self.dtypes.items())))
+
+    def sheet_names(self, workbook):
+        names = workbook.sheet_names
+        if self.sheet_columns is None:
+            return names
+        return [name for name in names if name in self.sheet_columns]
+
+    def open(self, source):
+        if isinstance(source, (bytes, bytearray)):
+            source = BytesIO(source)
+        try:
+            return pd.ExcelFile(source, engine=self.engine)
+        except ImportError:
+            if self.engine is None:
+                raise
+            if hasattr(source, 'seek'):
+                source.seek(0)
+            return pd.ExcelFile(source)
+
+    def read_sheet(self, workbook, sheet_name):
+        kwargs = {}
+        if self.sheet_columns is not None and self.sheet_columns.get(sheet_name) is not None:
+            wanted = set(self.sheet_columns[sheet_name])
+            kwargs['usecols'] = lambda column: column in wanted
+        if sheet_name in self.dtypes:
+            kwargs['dtype'] = self.dtypes[sheet_name]
+        return pd.read_excel(workbook, sheet_name, **kwargs)
+
+    def read_all(self, source):
+        workbook = self.open(source)
+        return {name: self.read_sheet(workbook, name) for name in self.sheet_names(workbook)}
 
 class ExcelProcessor:
-    def __init__(self, file_path):
-        self.workbook = pd.ExcelFile(file_path)
+    def __init__(self, file_path, reader=None):
+        self.reader = reader or ExcelReader()
+        self.workbook = self.reader.open(file_path)
 
     def load_excel_workbook(self, file_path):
-        return pd.ExcelFile(file_path)
+        return self.reader.open(file_path)
 
     def read_excel_sheet(self, workbook, sheet_name):
-        return pd.read_excel(workbook, sheet_name)
+        return self.reader.read_sheet(workbook, sheet_name)
+
+class WorkbookBundle:
+    # every sheet of one workbook, parsed once and keyed by the sha256 of its bytes
+    def __init__(self, digest, sheets):
+        self.digest = digest
+        self.sheets = sheets
+        self.sheet_names = list(sheets)
+
+    def __getitem__(self, sheet_name):
+        return self.sheets[sheet_name]
+
+    def read_bytes(source):
+        # accepts a path, raw bytes or a file-like object such as a streamlit UploadedFile
+        if isinstance(source, (bytes, bytearray)):
+            return bytes(source)
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                return f.read()
+        if hasattr(source, 'getvalue'):
+            return source.getvalue()
+        source.seek(0)
+        return source.read()
+
+    def from_bytes(data, digest=None, reader=None):
+        if digest is None:
+            digest = hashlib.sha256(data).hexdigest()
+        if reader is None:
+            sheets = pd.read_excel(BytesIO(data), sheet_name=None)
+        else:
+            sheets = reader.read_all(data)
+        return WorkbookBundle(digest, sheets)
+
+def read_sheet(source, sheet_name, reader=None):
+    # module level so it can run in a worker process; source is the workbook's bytes or
+    # the path of a file holding them
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    if reader is None:
+        return pd.read_excel(source, sheet_name=sheet_name)
+    return reader.read_sheet(reader.open(source), sheet_name)
+
+class WorkbookLoader:
+    # parses several workbooks, and the sheets inside each one, concurrently. openpyxl
+    # parsing holds the GIL, so the default is a process pool; the process workers get
+    # each workbook once, as a temporary file in temp_dir every sheet's task opens, rather
+    # than pickled into every task. The default is one worker per core, up to 4.
+    # Workbooks under min_parallel_bytes, and every workbook with workers=1 or on a single
+    # core, are parsed in the calling thread exactly like WorkbookBundle.from_bytes: the
+    # pool only pays for itself on large workbooks with cores to spare.
+    def __init__(self, workers=None, executor='process', reader=None, min_parallel_bytes=1024 * 1024, temp_dir=None):
+        if executor not in ('process', 'thread'):
+            raise ValueError(f"Unknown executor: {executor}")
+        self.workers = workers or min(4, multiprocessing.cpu_count())
+        self.executor = executor
+        self.reader = reader
+        self.min_parallel_bytes = min_parallel_bytes
+        self.temp_dir = temp_dir
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                if self.executor == 'process':
+                    # spawn instead of fork: the streamlit server process is multi-threaded
+                    self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+                else:
+                    self.pool = ThreadPoolExecutor(self.workers)
+            return self.pool
+
+    def parallel(self, data):
+        return self.workers > 1 and (os.cpu_count() or 1) > 1 and len(data) >= self.min_parallel_bytes
+
+    def submit(self, data, paths):
+        # lists the workbook's sheets and queues one task per sheet
+        if self.reader is None:
+            sheet_names = pd.ExcelFile(BytesIO(data)).sheet_names
+        else:
+            sheet_names = self.reader.sheet_names(self.reader.open(data))
+        source = data
+        if self.executor == 'process':
+            fd, source = tempfile.mkstemp(prefix='workbook-', dir=self.temp_dir)
+            paths.append(source)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+        pool = self.get_pool()
+        return sheet_names, [pool.submit(read_sheet, source, name, self.reader) for name in sheet_names]
+
+    def load(self, datas):
+        # datas is a list of workbook bytes; returns one WorkbookBundle per entry, in order.
+        # The pooled workbooks are queued first so the inline ones parse alongside them
+        paths = []
+        try:
+            jobs = {i: self.submit(data, paths) for i, data in enumerate(datas) if self.parallel(data)}
+            bundles = [None if i in jobs else WorkbookBundle.from_bytes(data, reader=self.reader) for i, data in enumerate(datas)]
+            for i, (sheet_names, futures) in jobs.items():
+                bundles[i] = WorkbookBundle(hashlib.sha256(datas[i]).hexdigest(),
+                                            {name: future.result() for name, future in zip(sheet_names, futures)})
+            return bundles
+        finally:
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+# type tags of the cells of a mixed-type object column (numbers and text in one column,
+# as data_grid_info columns often are), which Arrow cannot store as one typed column.
+# Such a column is stored as text plus a tag per cell and turned back into the values
+TAG_DECODERS = {'s': str, 'i': int, 'f': float, 'b': lambda text: text == 'True',
+                't': datetime.datetime.fromisoformat, 'h': datetime.time.fromisoformat}
+
+def tag_value(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return 'n', None
+    if isinstance(value, str):
+        return 's', value
+    if isinstance(value, (bool, np.bool_)):
+        return 'b', str(bool(value))
+    if isinstance(value, (int, np.integer)):
+        return 'i', str(int(value))
+    if isinstance(value, (float, np.floating)):
+        return 'f', repr(float(value))
+    if isinstance(value, datetime.datetime):
+        return 't', value.isoformat()
+    if isinstance(value, datetime.time):
+        return 'h', value.isoformat()
+    raise TypeError(f"Cannot cache a cell of type {type(value).__name__}")
+
+def untag_values(tags, texts):
+    return [np.nan if tag == 'n' else TAG_DECODERS[tag](text) for tag, text in zip(tags, texts)]
+
+class SheetDiskCache:
+    # parsed sheets stored on disk as uncompressed Arrow IPC files, one directory per
+    # workbook hash, so they survive restarts and are shared by every worker process.
+    # Reads memory-map the files. Every sheet is read back once when it is written and
+    # the workbook is only cached if it round-trips to the same values. Least recently
+    # used workbooks are deleted once the directory grows past max_bytes. Object columns
+    # mixing types are stored type-tagged (tag_value). Without pyarrow installed the cache
+    # is a no-op.
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, namespace=''):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # sheets parsed with different reader settings must not share entries
+        self.namespace = namespace
+        self.enabled = pyarrow is not None
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest):
+        key = hashlib.sha256((self.namespace + digest).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def read_frame(path, object_columns, tagged_columns=()):
+        with pyarrow.memory_map(path) as source:
+            df = pyarrow.ipc.open_file(source).read_all().to_pandas()
+        for col in object_columns:
+            # Arrow gives strings back as str dtype with None for nulls; read_excel gives object with NaN
+            df[col] = df[col].astype(object).where(df[col].notna(), np.nan)
+        for position, tag_column in tagged_columns:
+            df[df.columns[position]] = untag_values(df[tag_column].tolist(), df.iloc[:, position].tolist())
+        return df.drop(columns=[tag_column for position, tag_column in tagged_columns])
+
+    def tag_frame(df):
+        # df with each object column Arrow cannot convert as text, and a tag column after
+        # the others per such column; returns it with the (position, tag column) pairs
+        tagged = []
+        for position, col in enumerate(df.columns):
+            if df[col].dtype != object:
+                continue
+            try:
+                pyarrow.array(df[col], from_pandas=True)
+            except pyarrow.ArrowException:
+                tagged.append(position)
+        if not tagged:
+            return df, []
+        df = df.copy()
+        tagged_columns = []
+        for position in tagged:
+            tags, texts = zip(*map(tag_value, df.iloc[:, position].tolist())) if len(df) else ((), ())
+            tag_column = f'__tags_{position}__'
+            df.isetitem(position, pd.Series(texts, index=df.index, dtype=object))
+            df[tag_column] = pd.Series(tags, index=df.index, dtype=object)
+            tagged_columns.append((position, tag_column))
+        return df, tagged_columns
+
+    def get(self, digest):
+        if not self.enabled:
+            return None
+        path = self.path(digest)
+        try:
+            with open(os.path.join(path, 'sheets.json')) as f:
+                manifest = json.load(f)
+            sheets = {sheet['name']: SheetDiskCache.read_frame(os.path.join(path, sheet['file']), sheet['object_columns'],
+                                                               sheet.get('tagged_columns', ()))
+                      for sheet in manifest}
+            os.utime(path)
+        except (OSError, ValueError, KeyError, pyarrow.ArrowException):
+            return None
+        return WorkbookBundle(digest, sheets)
+
+    def put(self, bundle):
+        if not self.enabled:
+            return False
+        path = self.path(bundle.digest)
+        if os.path.exists(os.path.join(path, 'sheets.json')):
+            return True
+        staging = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        try:
+            manifest = []
+            for i, (name, df) in enumerate(bundle.sheets.items()):
+                file = f'{i}.arrow'
+                stored, tagged_columns = SheetDiskCache.tag_frame(df)
+                table = pyarrow.Table.from_pandas(stored, preserve_index=True)
+                with pyarrow.OSFile(os.path.join(staging, file), 'wb') as sink:
+                    with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+                tagged = {position for position, tag_column in tagged_columns}
+                object_columns = [col for position, col in enumerate(df.columns) if df[col].dtype == object and position not in tagged]
+                restored = SheetDiskCache.read_frame(os.path.join(staging, file), object_columns, tagged_columns)
+                pd.testing.assert_frame_equal(df, restored, check_dtype=False)
+                manifest.append({'name': name, 'file': file, 'object_columns': object_columns, 'tagged_columns': tagged_columns})
+            with open(os.path.join(staging, 'sheets.json'), 'w') as f:
+                json.dump(manifest, f)
+            try:
+                os.replace(staging, path)
+            except OSError:
+                # another process cached the same workbook first
+                shutil.rmtree(staging, ignore_errors=True)
+        except (pyarrow.ArrowException, AssertionError, TypeError, ValueError, OSError):
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+        self.evict()
+        return True
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.tmp-') or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, path))
+            total += size
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+class WorkbookCache:
+    # bounded LRU of WorkbookBundle objects shared across streamlit reruns, optionally
+    # backed by a SheetDiskCache shared across restarts and processes. Paths are
+    # remembered with their mtime and size, so a template file on disk is only read and
+    # hashed again once it changes, and is then hot-reloaded.
+    def __init__(self, maxsize=8, loader=None, disk_cache=None):
+        self.maxsize = maxsize
+        self.loader = loader or WorkbookLoader(workers=1)
+        self.disk_cache = disk_cache
+        self.entries = OrderedDict()
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def get(self, source):
+        return self.get_many([source])[0]
+
+    def stamp(source):
+        if not isinstance(source, str):
+            return None
+        stat = os.stat(source)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def get_many(self, sources):
+        # bundles for several sources; the ones not cached yet are parsed together
+        stamps = [WorkbookCache.stamp(source) for source in sources]
+        digests = [None] * len(sources)
+        bundles = {}
+        with self.lock:
+            for i, (source, stamp) in enumerate(zip(sources, stamps)):
+                known = self.paths.get(source) if stamp is not None else None
+                if known is not None and known[0] == stamp and known[1] in self.entries:
+                    digests[i] = known[1]
+                    self.entries.move_to_end(known[1])
+                    bundles[known[1]] = self.entries[known[1]]
+        datas = {}
+        for i, (source, stamp) in enumerate(zip(sources, stamps)):
+            if digests[i] is None:
+                data = WorkbookBundle.read_bytes(source)
+                digests[i] = hashlib.sha256(data).hexdigest()
+                datas[digests[i]] = data
+        with self.lock:
+            for source, stamp, digest in zip(sources, stamps, digests):
+                if stamp is not None:
+                    self.paths[source] = (stamp, digest)
+            for digest in datas:
+                if digest in self.entries and digest not in bundles:
+                    self.entries.move_to_end(digest)
+                    bundles[digest] = self.entries[digest]
+        missing = {digest: data for digest, data in datas.items() if digest not in bundles}
+        if missing:
+            to_parse = {}
+            for digest, data in missing.items():
+                bundle = None if self.disk_cache is None else self.disk_cache.get(digest)
+                if bundle is None:
+                    to_parse[digest] = data
+                else:
+                    bundles[digest] = bundle
+            if to_parse:
+                for bundle in self.loader.load(list(to_parse.values())):
+                    bundles[bundle.digest] = bundle
+                    if self.disk_cache is not None:
+                        self.disk_cache.put(bundle)
+            with self.lock:
+                for digest in missing:
+                    self.entries[digest] = bundles[digest]
+                    self.entries.move_to_end(digest)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return [bundles[digest] for digest in digests]
+
+# a parsed document is counted at this multiple of its JSON size against ResultCache.max_bytes
+DOCUMENT_SIZE_FACTOR = 3
+
+def export_size(value):
+    # bytes an export holds: encoded buffers, (bytes, stats) pairs and ShardedMap files
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(export_size(part) for part in value)
+    files = getattr(value, 'files', None)
+    if files is not None:
+        return sum(len(data) for data in files.values())
+    return 0
+
+def frames_size(frames):
+    # deep memory usage of the validated sheet frames a result keeps
+    return sum(int(df.memory_usage(deep=True).sum()) for df in frames or () if df is not None)
+
+class JsonResult:
+    # finished output of one generation; json_bytes is the single encoded buffer shared by
+    # the download, the file writer and the database. patch_bytes is the JSON Patch from
+    # the project's previous revision when the map was regenerated incrementally. size
+    # counts the buffers and the validated frames kept for the page, and grows with every
+    # export built, the ResultCache holding the result being told
+    def __init__(self, json_bytes, validated_data, patch_bytes=None, stats=None):
+        self.json_bytes = json_bytes
+        self.validated_data = validated_data
+        self.patch_bytes = patch_bytes
+        self.stats = stats
+        self.size = len(json_bytes) + len(patch_bytes or b'') + frames_size(validated_data)
+        self._outline = None
+        self.exports = {}
+        self.owner = None
+        self.lock = threading.RLock()
+
+    def export(self, key, make, size=export_size):
+        # derived downloads (shards, other encodings) built once per result on first request
+        with self.lock:
+            if key in self.exports:
+                return self.exports[key]
+            value = self.exports[key] = make()
+            added = size(value)
+            self.size += added
+            owner = self.owner
+        if owner is not None:
+            cache, cache_key = owner
+            cache.grow(cache_key, self, added)
+        return value
+
+    def load_json(self):
+        return json.loads(self.json_bytes)
+
+    def document(self):
+        # the parsed map, shared by the encodings that work on the document
+        return self.export(('document',), self.load_json, lambda document: DOCUMENT_SIZE_FACTOR * len(self.json_bytes))
+
+    def encoded(self, name):
+        # (bytes, stats) of the map in one of EXPORT_ENCODINGS
+        return self.export(('encoding', name), lambda: encode_export(name, self.json_bytes, self.document))
+
+    def outline(self):
+        # the header fields and the length of each record array, kept so previews do not
+        # have to send the whole document
+        if self._outline is None:
+            document = self.document()
+            default = document.get('default', {})
+            self._outline = {'header': {key: value for key, value in document.items() if key != 'default'},
+                             'counts': {section: len(records) for section, records in default.items()}}
+        return self._outline
+
+    def records(self, section, start, stop):
+        # one page of default.node or default.node_connections, sliced from the one cached parse
+        return self.document()['default'][section][start:stop]
+
+class ResultCache:
+    # LRU of JsonResult objects, evicted once their outputs and exports exceed max_bytes
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old.size
+            self.entries[key] = result
+            result.owner = (self, key)
+            self.total_bytes += result.size
+            self.evict()
+        return result
+
+    def grow(self, key, result, nbytes):
+        # a cached result built an export; results evicted or replaced since are not counted
+        with self.lock:
+            if self.entries.get(key) is result:
+                self.total_bytes += nbytes
+                self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= evicted.size
+
+# image for each shape offered in 'Fill from UI' mode
+SHAPE_IMAGES = {'White Hexagon': 'https://association-map-cdn-public.s3.us-west-1.amazonaws.com/DragnetAlpha/AssociationMap/Stories2.png', 'Pink Hexagon': 'https://association-map-cdn-public.s3-us-west-1.amazonaws.com/DragnetAlpha/AssociationMap/Stories1.png', 'Blue Hexagon':'https://association-map-cdn-public.s3.us-west-1.amazonaws.com/DragnetAlpha/AssociationMap/Target+Entity+1.png', 'Sky Blue Circle':'https://association-map-cdn-public.s3-us-west-1.amazonaws.com/DragnetAlpha/AssociationMap/Entity.png', 'Violet Hexagon': 'https://association-map-cdn-public.s3.us-west-1.amazonaws.com/DragnetAlpha/AssociationMap/Target+Entity+3.png'}
+
+# data grid fields in the order they appear in each node record; the fields in
+# DATA_GRID_STR_FIELDS are written as str() of the cell instead of the raw value
+DATA_GRID_FIELDS = ['data_grid_info1', 'data_grid_info2', 'data_grid_info3', 'data_grid_title1', 'data_grid_title2',
+                    'data_grid_title3', 'data_grid_info4', 'data_grid_title4', 'data_grid_title5', 'data_grid_info5']
+DATA_GRID_STR_FIELDS = ['data_grid_info2', 'data_grid_title1']
+
+class StyleTables:
+    # the features template compiled once per template hash into lookups that are only
+    # read afterwards, so every session using the template shares them: node style rows
+    # by Component, edge style rows by L2 and the legend image by Component. Joining
+    # through them gives the same rows, columns and order as merging with the sheets;
+    # when Component or L2 repeat (a merge then multiplies rows) or column names clash,
+    # join_nodes/join_edges fall back to the merge
+    def __init__(self, digest, nodes, edge):
+        self.digest = digest
+        self.nodes = nodes
+        self.edge = edge
+        self.node_index = pd.Index(nodes['Component'])
+        self.edge_index = pd.Index(edge['L2'])
+        self.edge_styles = edge.drop(columns=['L2'])
+        first = nodes.drop_duplicates('Component')
+        self.legend_urls = MappingProxyType(dict(zip(first['Component'].tolist(), first['node_image'].tolist())))
+
+    def compile(map_feature, digest=None):
+        return StyleTables(digest, map_feature['Nodes'], map_feature['Edge'])
+
+    def lookup(index, keys, table, frame):
+        positions = index.get_indexer(keys)
+        found = positions >= 0
+        left = frame[found].reset_index(drop=True)
+        right = table.take(positions[found]).reset_index(drop=True)
+        return pd.concat([left, right], axis=1)
+
+    def join_nodes(self, sample):
+        # pd.merge(sample, Nodes, left_on='SubType', right_on='Component')
+        if not self.node_index.is_unique or sample.columns.intersection(self.nodes.columns).size:
+            return pd.merge(sample, self.nodes, left_on='SubType', right_on='Component')
+        return StyleTables.lookup(self.node_index, sample['SubType'], self.nodes, sample)
+
+    def join_edges(self, df):
+        # df.merge(Edge, on='L2')
+        if not self.edge_index.is_unique or df.columns.intersection(self.edge_styles.columns).size:
+            return df.merge(self.edge, on='L2')
+        return StyleTables.lookup(self.edge_index, df['L2'], self.edge_styles, df)
+
+    def legend(self, distinct_values):
+        # GlobalProcessor1.process_global_data without a scan of the sheet per SubType
+        return {value: self.legend_urls[value] for value in distinct_values}
+
+class NodeBuilder:
+    # builds the node records column by column instead of row by row
+    def __init__(self, sample, map_feature, styles=None):
+        if styles is None:
+            self.x = pd.merge(sample, map_feature['Nodes'], left_on='SubType', right_on='Component')
+        else:
+            self.x = styles.join_nodes(sample)
+
+    def blank_nan(column, as_str=False):
+        values = column.to_numpy(dtype=object)
+        mask = column.isna().to_numpy() | (values == "nan")
+        if as_str:
+            values = column.astype(str).to_numpy(dtype=object)
+        return np.where(mask, " ", values).tolist()
+
+    def clean_names(column):
+        return column.str.replace('("', '(', regex=False).str.replace('"', ')', regex=False) \
+            .str.encode('ascii', 'ignore').str.decode('ascii').tolist()
+
+    def build(self, node_images=None):
+        # node_images maps SubType -> image url; when None the template's node_image column is used
+        return NodeBuilder.build_frame(self.x, node_images)
+
+    def iter_build(self, node_images=None, chunk_size=10000):
+        for start in range(0, len(self.x), chunk_size):
+            yield from NodeBuilder.build_frame(self.x.iloc[start:start + chunk_size], node_images)
+
+    def build_frame(x, node_images=None):
+        if node_images is None:
+            images = x['node_image'].tolist()
+        else:
+            images = x['SubType'].map(node_images).tolist()
+        grid = zip(*[NodeBuilder.blank_nan(x[field], field in DATA_GRID_STR_FIELDS) for field in DATA_GRID_FIELDS])
+        columns = zip(
+            NodeBuilder.clean_names(x['Name']),
+            x['SubType'].tolist(),
+            x['Node Id'].tolist(),
+            grid,
+            x['node_size'].astype(int).tolist(),
+            x['node_shape'].tolist(),
+            np.where(x['node_shadow'].to_numpy() == 0, 'false', 'true').tolist(),
+            x['node_label_font_size'].astype(int).tolist(),
+            x['node_label_font_color'].tolist(),
+            x['node_label_font_background'].tolist(),
+            x['node_label_font_alignment'].tolist(),
+            images,
+            x['node_color'].tolist(),
+        )
+        return [
+            {
+                "name": name,
+                "SubType": subtype,
+                "UID": uid,
+                "data_grid_properties": {
+                    "data_grid_info1": info1,
+                    "data_grid_info2": info2,
+                    "data_grid_info3": info3,
+                    "data_grid_title1": title1,
+                    "data_grid_title2": title2,
+                    "data_grid_title3": title3,
+                    "data_grid_info4": info4,
+                    "data_grid_title4": title4,
+                    "data_grid_title5": title5,
+                    "data_grid_info5": info5,
+                    "data_grid_properties": " "
+                },
+                "node_properties": {
+                    "node_size": size,
+                    "node_shape": shape,
+                    "node_shadow": shadow,
+                    "node_label_font_size": font_size,
+                    "node_label_font_color": font_color,
+                    "node_label_font_background": font_background,
+                    "node_label_font_alignment": font_alignment,
+                    "node_image": image,
+                    "node_color": color
+                }
+            }
+            for name, subtype, uid, (info1, info2, info3, title1, title2, title3, info4, title4, title5, info5),
+                size, shape, shadow, font_size, font_color, font_background, font_alignment, image, color in columns
+        ]
 
 class NodeProcessor:
-    def __init__(self, sample, map_feature, connection, d, dict1):
+    def __init__(self, sample, map_feature, connection, d, dict1, styles=None):
         self.sample = sample
         self.connection=connection
-        self.merged=pd.merge(sample,connection,left_on='Node Id',right_on='from',how='outer')
         self.map_feature=map_feature
         self.d = d
         self.dict1 = dict1
+        self.styles = styles
 
     def process_node_data(self, sample, map_feature, connection, d, dict1):
-      nodes = []
-      x=pd.merge(self.sample,self.map_feature['Nodes'],left_on='SubType', right_on='Component')
-      for index, row in x.iterrows():
-          node = {
-              "name": row['Name'].replace('("','(').replace('"',')').encode('ascii','ignore').decode(),
-              "SubType": row['SubType'],
-              "UID": row['Node Id'],
-              "data_grid_properties": {
-                  "data_grid_info1": " " if str(row['data_grid_info1']) == "nan" else row['data_grid_info1'],
-                  "data_grid_info2": " " if str(row['data_grid_info2']) == "nan" else str(row['data_grid_info2']),
-                  "data_grid_info3": " " if str(row['data_grid_info3']) == "nan" else row['data_grid_info3'],
-                  "data_grid_title1": " " if str(row['data_grid_title1']) == "nan" else str(row['data_grid_title1']),
-                  "data_grid_title2": " " if str(row['data_grid_title2']) == "nan" else row['data_grid_title2'],
-                  "data_grid_title3": " " if str(row['data_grid_title3']) == "nan" else row['data_grid_title3'],
-                  "data_grid_info4": " " if str(row['data_grid_info4']) == "nan" else row['data_grid_info4'],
-                  "data_grid_title4": " " if str(row['data_grid_title4']) == "nan" else row['data_grid_title4'],
-                  "data_grid_title5": " " if str(row['data_grid_title5']) == "nan" else row['data_grid_title5'],
-                  "data_grid_info5": " " if str(row['data_grid_info5']) == "nan" else row['data_grid_info5'],
-                  "data_grid_properties": " "
-              },
-              "node_properties": {
-                  "node_size": int(row["node_size"]),
-                  "node_shape": row["node_shape"],
-                  "node_shadow": 'false' if row["node_shadow"]==0 else 'true',
-                  "node_label_font_size": int(row["node_label_font_size"]),
-                  "node_label_font_color": row["node_label_font_color"],
-                  "node_label_font_background": row["node_label_font_background"],
-                  "node_label_font_alignment": row["node_label_font_alignment"],
-                  #"node_image": row["node_image"],
-                  "node_image": dict1[d[row['SubType']]],
-                  "node_color": row["node_color"]
-              }
-          }
-          nodes.append(node)
-      return nodes
+      builder = NodeBuilder(self.sample, self.map_feature, self.styles)
+      return builder.build(self.node_images(builder, d, dict1))
+
+    def iter_node_data(self, chunk_size=10000):
+      builder = NodeBuilder(self.sample, self.map_feature, self.styles)
+      return builder.iter_build(self.node_images(builder, self.d, self.dict1), chunk_size)
+
+    def node_images(self, builder, d, dict1):
+      # resolve each SubType's image once; a SubType missing from d or dict1 raises KeyError as before
+      return {subtype: dict1[d[subtype]] for subtype in builder.x['SubType'].unique()}
     
 class NodeProcessor1:
-    def __init__(self, sample, map_feature, connection):
+    def __init__(self, sample, map_feature, connection, styles=None):
         self.sample = sample
         self.connection=connection
-        self.merged=pd.merge(sample,connection,left_on='Node Id',right_on='from',how='outer')
         self.map_feature=map_feature
+        self.styles = styles
 
     def process_node_data(self, sample, map_feature, connection):
-      nodes = []
-      x=pd.merge(self.sample,self.map_feature['Nodes'],left_on='SubType', right_on='Component')
-      for index, row in x.iterrows():
-          node = {
-              "name": row['Name'].replace('("','(').replace('"',')').encode('ascii','ignore').decode(),
-              "SubType": row['SubType'],
-              "UID": row['Node Id'],
-              "data_grid_properties": {
-                  "data_grid_info1": " " if str(row['data_grid_info1']) == "nan" else row['data_grid_info1'],
-                  "data_grid_info2": " " if str(row['data_grid_info2']) == "nan" else str(row['data_grid_info2']),
-                  "data_grid_info3": " " if str(row['data_grid_info3']) == "nan" else row['data_grid_info3'],
-                  "data_grid_title1": " " if str(row['data_grid_title1']) == "nan" else str(row['data_grid_title1']),
-                  "data_grid_title2": " " if str(row['data_grid_title2']) == "nan" else row['data_grid_title2'],
-                  "data_grid_title3": " " if str(row['data_grid_title3']) == "nan" else row['data_grid_title3'],
-                  "data_grid_info4": " " if str(row['data_grid_info4']) == "nan" else row['data_grid_info4'],
-                  "data_grid_title4": " " if str(row['data_grid_title4']) == "nan" else row['data_grid_title4'],
-                  "data_grid_title5": " " if str(row['data_grid_title5']) == "nan" else row['data_grid_title5'],
-                  "data_grid_info5": " " if str(row['data_grid_info5']) == "nan" else row['data_grid_info5'],
-                  "data_grid_properties": " "
-              },
-              "node_properties": {
-                  "node_size": int(row["node_size"]),
-                  "node_shape": row["node_shape"],
-                  "node_shadow": 'false' if row["node_shadow"]==0 else 'true',
-                  "node_label_font_size": int(row["node_label_font_size"]),
-                  "node_label_font_color": row["node_label_font_color"],
-                  "node_label_font_background": row["node_label_font_background"],
-                  "node_label_font_alignment": row["node_label_font_alignment"],
-                  "node_image": row["node_image"],
-                  "node_color": row["node_color"]
-              }
-          }
-          nodes.append(node)
-      return nodes
+      return NodeBuilder(self.sample, self.map_feature, self.styles).build()
+
+    def iter_node_data(self, chunk_size=10000):
+      return NodeBuilder(self.sample, self.map_feature, self.styles).iter_build(chunk_size=chunk_size)
     
 class GlobalProcessor1:
     def __init__(self, node_df, distinct_values):
@@ -117,30 +738,63 @@ class GlobalProcessor1:
         legend_data[distinct_values[i]] = url
       return legend_data
 
+def style_edges(df, map_feature, styles=None):
+    # joins each edge's template style on its L2 level and formats the columns as written
+    if styles is None:
+        df = df.merge(map_feature['Edge'], on='L2')
+    else:
+        df = styles.join_edges(df)
+    df = df.drop(['L2'], axis=1)
+    df['edge_dashes'] = df['edge_dashes'].astype('bool')
+    df['edge_dashes'] = df['edge_dashes'].replace([True, False], ['true', 'false'])
+    return df
+
 class ConnectionProcessor:
-    def __init__(self, sample, map_feature, connection):
+    def __init__(self, sample, map_feature, connection, keyed=False, styles=None):
         self.connection=connection
-        self.merged=pd.merge(sample,connection,left_on='Node Id',right_on='from',how='outer')
+        self.sample=sample
+        self.keyed=keyed
         self.map_feature=map_feature
+        self.styles=styles
+        self.frame=None
 
     def process_connection_data(self):
-      sample=self.merged
+      return self.build_connection_frame().to_dict('records')
+
+    def iter_connection_data(self, chunk_size=10000):
+      df=self.connection_frame()
+      for start in range(0, df.shape[0], chunk_size):
+          yield from df.iloc[start:start + chunk_size].to_dict('records')
+
+    def connection_frame(self):
+      # built once, so the edge records and the index share one frame
+      if self.frame is None:
+          self.frame=self.build_connection_frame()
+      return self.frame
+
+    def build_connection_frame(self):
+      # only the join keys are carried through the outer merge; its row order is what
+      # the edge list (and so the UIDs) has always been built from. keyed also carries
+      # each connection's row label, kept with its Level so every edge can be matched
+      # back to its row
+      columns=self.connection[['from','to','Level']]
+      if self.keyed:
+          columns=columns.assign(row=self.connection.index)
+      sample=pd.merge(self.sample[['Node Id']],columns,left_on='Node Id',right_on='from',how='outer')
       sample['to']=sample['to'].fillna(-1)
       sample["to"]=sample["to"].astype('int')
-      l=[]
-      node=sample['Node Id'].unique()
-      for index, row in sample.iterrows():
-          if row['to'] != -1 and row['to'] in node :
-              con=sample[sample['Node Id']==row['to']].iloc[0]
-              l.append([int(row['Node Id']),int(row['to']),row['Level']])
-      df=pd.DataFrame(columns=['from','to','L2'],data=l)
-      df=df.merge(self.map_feature['Edge'],on='L2').drop(['L2'],axis=1)
-      df['edge_dashes']=df['edge_dashes'].astype('bool')
-      df['edge_dashes']=df['edge_dashes'].replace([True,False],['true','false'])
+      # hash lookup of 'to' against the node ids instead of scanning them for every row
+      keep=(sample['to'] != -1) & sample['to'].isin(sample['Node Id'].dropna())
+      kept=sample[keep]
+      df=pd.DataFrame({'from':kept['Node Id'].astype('int'),'to':kept['to'],'L2':kept['Level']}).reset_index(drop=True)
+      if self.keyed:
+          df['row']=kept['row'].astype('int').to_numpy()
+          df['Level']=kept['Level'].to_numpy()
+      df=style_edges(df, self.map_feature, self.styles)
       df.sort_values(by='from',inplace=True)
       df['UID']=[i for i in range(1,df.shape[0]+1)]
 
-      return df.to_dict('records')
+      return df
 
 class GlobalProcessor:
     def __init__(self, dict1, distinct_values, d):
@@ -171,8 +825,17 @@ class JsonGenerator:
         self.excel_dict=dict()
 
     def create_json_output(self, legend_data, client_name, logo_url, sidebar_short_logo, nodes, connections, nodes_df_, global_df, map_feature, node_df):
+      json_output = self.create_json_header(legend_data, client_name, logo_url, sidebar_short_logo, global_df, node_df)
+      json_output["default"] = {
+          "node": nodes,
+          "node_connections": connections
+      }
+      return json_output
+
+    def create_json_header(self, legend_data, client_name, logo_url, sidebar_short_logo, global_df, node_df):
+      # every top level key of the output except "default"
       json_list = json.loads(global_df['background_mode'][0])
-      json_output = {
+      return {
           'legend': legend_data,
           'client_name': client_name,
           'logo_url': logo_url,
@@ -181,28 +844,324 @@ class JsonGenerator:
           'search_case_name': 'beacon',
           'filters': {
               'type': list(node_df['Type'].unique())
-          },
-          "default": {
-              "node": nodes,
-              "node_connections": connections
           }
       }
-      return json_output
+
+class JsonStreamEncoder:
+    # encodes the output document piece by piece: the header keys first, then the
+    # default.node and default.node_connections arrays a batch of records at a time, so
+    # the records can come from generators and never have to be held as a full list.
+    # The default mode matches json.dumps(indent=2) byte for byte; compact mode drops
+    # all whitespace. backend='orjson' is faster but writes non-ascii text as utf-8 and
+    # NaN as null, so it is only used when asked for; backend='auto' uses orjson when it is
+    # installed.
+    def __init__(self, compact=False, backend='json', batch_size=1000):
+        if backend == 'auto':
+            backend = 'json' if orjson is None else 'orjson'
+        if backend == 'orjson' and orjson is None:
+            raise ValueError("orjson backend requested but orjson is not installed")
+        if backend not in ('json', 'orjson'):
+            raise ValueError(f"Unknown JSON backend: {backend}")
+        self.compact = compact
+        self.backend = backend
+        self.batch_size = batch_size
+
+    def dumps(self, obj, depth=0):
+        # obj encoded as it appears nested depth levels deep in the document
+        if self.backend == 'orjson':
+            if self.compact:
+                return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+            data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+        elif self.compact:
+            return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+        else:
+            data = json.dumps(obj, indent=2).encode('utf-8')
+        if depth:
+            data = data.replace(b'\n', b'\n' + b'  ' * depth)
+        return data
+
+    def iter_array(self, records, depth):
+        if self.compact:
+            opening, separator, closing = b'[', b',', b']'
+        else:
+            item_indent = b'\n' + b'  ' * (depth + 1)
+            opening, separator, closing = b'[' + item_indent, b',' + item_indent, b'\n' + b'  ' * depth + b']'
+        batch = []
+        empty = True
+        for record in records:
+            batch.append(self.dumps(record, depth + 1))
+            if len(batch) == self.batch_size:
+                yield (opening if empty else separator) + separator.join(batch)
+                empty = False
+                batch = []
+        if batch:
+            yield (opening if empty else separator) + separator.join(batch)
+            empty = False
+        yield b'[]' if empty else closing
+
+    def iter_chunks(self, header, nodes, connections, trailer=None):
+        # trailer returns top level keys written after "default"; it is called once the
+        # records have been consumed, so it can describe them
+        if self.compact:
+            head = self.dumps(header)[:-1]
+            yield head + (b',' if header else b'') + b'"default":{"node":'
+            yield from self.iter_array(nodes, 2)
+            yield b',"node_connections":'
+            yield from self.iter_array(connections, 2)
+            yield b'}'
+            for key, value in (trailer() if trailer else {}).items():
+                yield b',' + self.dumps(key) + b':' + self.dumps(value)
+            yield b'}'
+        else:
+            head = self.dumps(header)[:-2] if header else b'{'
+            yield head + (b',' if header else b'') + b'\n  "default": {\n    "node": '
+            yield from self.iter_array(nodes, 2)
+            yield b',\n    "node_connections": '
+            yield from self.iter_array(connections, 2)
+            yield b'\n  }'
+            for key, value in (trailer() if trailer else {}).items():
+                yield b',\n  ' + self.dumps(key) + b': ' + self.dumps(value, 1)
+            yield b'\n}'
+
+    def encode(self, header, nodes, connections, trailer=None):
+        return b''.join(self.iter_chunks(header, nodes, connections, trailer))
+
+    def write(self, file, header, nodes, connections, trailer=None):
+        for chunk in self.iter_chunks(header, nodes, connections, trailer):
+            file.write(chunk)
+
+# Format 2 writes each distinct node_properties block and edge style once, in a top level
+# "styles" table after "default", and has every record refer to its style by position:
+# nodes carry "style" instead of "node_properties", edges keep from, to and UID plus
+# "style". expand_v2 turns such a document back into the format 1 layout.
+EDGE_RECORD_KEYS = ('from', 'to', 'UID')
+
+class StyleIds:
+    # distinct style dicts in first-seen order; a style's id is its position
+    def __init__(self):
+        self.ids = {}
+        self.styles = []
+
+    def id(self, style):
+        key = tuple(style.items())
+        style_id = self.ids.get(key)
+        if style_id is None:
+            style_id = self.ids[key] = len(self.styles)
+            self.styles.append(style)
+        return style_id
+
+def iter_v2_nodes(nodes, node_styles):
+    for node in nodes:
+        record = {key: value for key, value in node.items() if key != 'node_properties'}
+        record['style'] = node_styles.id(node['node_properties'])
+        yield record
+
+def iter_v2_edges(connections, edge_styles):
+    for edge in connections:
+        style = {key: value for key, value in edge.items() if key not in EDGE_RECORD_KEYS}
+        yield {'from': edge['from'], 'to': edge['to'], 'UID': edge['UID'], 'style': edge_styles.id(style)}
+
+def encode_v2(encoder, header, nodes, connections):
+    node_styles, edge_styles = StyleIds(), StyleIds()
+    return encoder.encode(dict(header, format_version=2), iter_v2_nodes(nodes, node_styles), iter_v2_edges(connections, edge_styles),
+                          lambda: {'styles': {'node': node_styles.styles, 'edge': edge_styles.styles}})
+
+def expand_v2(document):
+    # the format 1 document for a format 2 one, for viewers that only read format 1
+    node_styles = document['styles']['node']
+    edge_styles = document['styles']['edge']
+    expanded = {key: value for key, value in document.items() if key not in ('format_version', 'default', 'styles')}
+    nodes = []
+    for node in document['default']['node']:
+        record = {key: value for key, value in node.items() if key != 'style'}
+        record['node_properties'] = dict(node_styles[node['style']])
+        nodes.append(record)
+    connections = [dict({'from': edge['from'], 'to': edge['to']}, **edge_styles[edge['style']], UID=edge['UID'])
+                   for edge in document['default']['node_connections']]
+    expanded['default'] = {'node': nodes, 'node_connections': connections}
+    return expanded
+
+def build_legend(map_feature, choice1, d, dict1, distinct_values, styles=None):
+    if choice1 == 'Fill from UI':
+        return GlobalProcessor.process_global_data(dict1, distinct_values, d)
+    if styles is not None:
+        return styles.legend(distinct_values)
+    return GlobalProcessor1.process_global_data(map_feature['Nodes'], distinct_values)
+
+def build_header(map_feature, node_df, legend_data, nodes=None, connections=None):
+    # every top level key of the output except "default"
+    global_df_ = map_feature['Global']
+    nodes_df_ = map_feature['Nodes']
+    json_generator = JsonGenerator(legend_data, global_df_['client_name'].values[0], global_df_['logo_url'].values[0], global_df_['sidebar_short_logo'].values[0], nodes, connections, nodes_df_, global_df_, map_feature, node_df)
+    return json_generator.create_json_header(legend_data, global_df_['client_name'].values[0], global_df_['logo_url'].values[0], global_df_['sidebar_short_logo'].values[0], global_df_, node_df)
+
+def index_node_frame(node_df, map_feature):
+    # Node Id, Type and SubType of the nodes in the output, in output order
+    return pd.merge(node_df[['Node Id', 'Type', 'SubType']], map_feature['Nodes'][['Component']], left_on='SubType', right_on='Component')
+
+def inverted_index(uids, values):
+    # value -> UIDs having it; blank values are listed under " " like blank data grid cells
+    values = pd.Series(values).fillna(" ")
+    groups = values.groupby(values, sort=False).indices
+    return {str(value): uids[positions].tolist() for value, positions in groups.items()}
+
+def build_index(node_frame, connection_frame):
+    # search and filter indexes for the viewer, computed with numpy over the frames the
+    # processors build. neighbors is a CSR layout: the neighbours of uids[i] (edges in
+    # either direction) are neighbors[offsets[i]:offsets[i + 1]], reached through the
+    # edges with the UIDs at the same positions of edges
+    node_frame = node_frame.drop_duplicates('Node Id')
+    uids = node_frame['Node Id'].to_numpy(dtype='int64')
+    positions = pd.Index(uids)
+    source = connection_frame['from'].to_numpy(dtype='int64')
+    target = connection_frame['to'].to_numpy(dtype='int64')
+    edge_uids = connection_frame['UID'].to_numpy(dtype='int64')
+
+    rows = positions.get_indexer(np.concatenate([source, target]))
+    other = np.concatenate([target, source])
+    through = np.concatenate([edge_uids, edge_uids])
+    present = rows >= 0
+    order = np.argsort(rows[present], kind='stable')
+    degree = np.bincount(rows[present], minlength=len(uids))
+    out_positions = positions.get_indexer(source)
+    in_positions = positions.get_indexer(target)
+    return {
+        'neighbors': {
+            'uids': uids.tolist(),
+            'offsets': np.concatenate([[0], np.cumsum(degree)]).tolist(),
+            'neighbors': other[present][order].tolist(),
+            'edges': through[present][order].tolist(),
+        },
+        'degree': degree.tolist(),
+        'out_degree': np.bincount(out_positions[out_positions >= 0], minlength=len(uids)).tolist(),
+        'in_degree': np.bincount(in_positions[in_positions >= 0], minlength=len(uids)).tolist(),
+        'by_type': inverted_index(uids, node_frame['Type'].to_numpy(dtype=object)),
+        'by_subtype': inverted_index(uids, node_frame['SubType'].to_numpy(dtype=object)),
+        'by_connection_type': inverted_index(edge_uids, connection_frame['connection_type'].to_numpy(dtype=object)),
+    }
+
+def deferred(make):
+    # generator that only calls make() when its first item is asked for, so the merges
+    # behind a lazy stage run (and are timed) while the stage is being consumed
+    yield from make()
+
+# function to run the node, connection and legend processors and encode the JSON output;
+# run is a PipelineRun from association_map_metrics that times each stage, and index adds
+# the top level "index" section from build_index; styles are the template's StyleTables and
+# format_version=2 writes the compact format of encode_v2
+def generate_json(bundle_AM, bundle_RM, choice1, d, dict1, distinct_values, encoder=None, run=NULL_RUN, index=False, styles=None,
+                  format_version=1):
+    node_df = bundle_AM['Node']
+    connection_df = bundle_AM['Connections']
+    map_feature = bundle_RM.sheets
+
+    if choice1 == 'Fill from UI':
+        node_processor = NodeProcessor(node_df, map_feature, connection_df, d, dict1, styles)
+    else:
+        node_processor = NodeProcessor1(node_df, map_feature, connection_df, styles)
+    nodes = run.timed_iter('node_build', deferred(node_processor.iter_node_data), len(node_df))
+
+    connection_processor = ConnectionProcessor(node_df, map_feature, connection_df, styles=styles)
+    connections = run.timed_iter('edge_build', connection_processor.iter_connection_data(), len(connection_df))
+
+    with run.stage('legend', rows_in=len(distinct_values)) as record:
+        legend_data = build_legend(map_feature, choice1, d, dict1, distinct_values, styles)
+        record['rows_out'] = len(legend_data)
+
+    header = build_header(map_feature, node_df, legend_data, nodes, connections)
+    if index:
+        with run.stage('index', rows_in=len(node_df) + len(connection_df)):
+            header['index'] = build_index(index_node_frame(node_df, map_feature), connection_processor.connection_frame())
+    if encoder is None:
+        encoder = JsonStreamEncoder()
+    with run.stage('json_encode', exclude=('node_build', 'edge_build')) as record:
+        if format_version == 2:
+            json_bytes = encode_v2(encoder, header, nodes, connections)
+        else:
+            json_bytes = encoder.encode(header, nodes, connections)
+        record['bytes'] = len(json_bytes)
+    return json_bytes
+
+class ExportEncoding:
+    # one download format of a generated map. Text encodings compress the JSON bytes as
+    # they are; binary ones (from_document) serialise the parsed document. module is the
+    # optional package the encoding needs, None when it is not installed.
+    def __init__(self, extension, mime, encode, decode, from_document=False, package=None, module=True):
+        self.extension = extension
+        self.mime = mime
+        self.encode = encode
+        self.decode = decode
+        self.from_document = from_document
+        self.package = package
+        self.module = module
+
+    def available(self):
+        return self.module is not None
+
+EXPORT_ENCODINGS = {
+    'json': ExportEncoding('.json', 'application/json', lambda data: data, json.loads),
+    'json.gz': ExportEncoding('.json.gz', 'application/gzip', lambda data: gzip.compress(data, compresslevel=6, mtime=0),
+                              lambda data: json.loads(gzip.decompress(data))),
+    'json.br': ExportEncoding('.json.br', 'application/octet-stream', lambda data: brotli.compress(data, quality=9),
+                              lambda data: json.loads(brotli.decompress(data)), package='brotli', module=brotli),
+    'msgpack': ExportEncoding('.msgpack', 'application/msgpack', lambda document: msgpack.packb(document, use_bin_type=True),
+                              lambda data: msgpack.unpackb(data, raw=False), from_document=True, package='msgpack', module=msgpack),
+    'cbor': ExportEncoding('.cbor', 'application/cbor', lambda document: cbor2.dumps(document), lambda data: cbor2.loads(data),
+                           from_document=True, package='cbor2', module=cbor2),
+}
+
+def export_encodings():
+    # names of the encodings whose packages are installed
+    return [name for name, encoding in EXPORT_ENCODINGS.items() if encoding.available()]
+
+def encode_export(name, json_bytes, document=None):
+    # (encoded bytes, stats) of a generated map in one export encoding. document returns
+    # the parsed map for the binary encodings (parsed from json_bytes when not given); the
+    # stats time one encode and one decode back to the document
+    encoding = EXPORT_ENCODINGS[name]
+    if not encoding.available():
+        raise ImportError(f"The {name} encoding needs the {encoding.package} package")
+    source = json_bytes
+    if encoding.from_document:
+        source = document() if document is not None else json.loads(json_bytes)
+    start = time.perf_counter()
+    data = encoding.encode(source)
+    encode_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    encoding.decode(data)
+    decode_seconds = time.perf_counter() - start
+    return data, {'encoding': name, 'bytes': len(data), 'ratio': round(len(json_bytes) / len(data), 2) if data else None,
+                  'encode_seconds': round(encode_seconds, 4), 'decode_seconds': round(decode_seconds, 4)}
 
 class JSONFile:
     def __init__(self, json_output, output_file_path='output.json'):
         self.json_output = json_output
         self.output_file_path = output_file_path
 
-    def write_json_to_file(json_output, output_file_path='output.json'):
-        with open(output_file_path, 'w') as json_file:
-            json.dump(json_output, json_file, indent=2)
-        print(f"JSON output file '{output_file_path}' generated successfully.")
+    def write_json_to_file(json_output, output_file_path='output.json', encoding='json'):
+        write_json_to_file(json_output, output_file_path, encoding)
 
 
-def write_json_to_file(json_output, output_file_path='output.json'):
-    with open(output_file_path, 'w') as json_file:
-        json.dump(json_output, json_file, indent=2)
+def write_json_to_file(json_output, output_file_path='output.json', encoding='json'):
+    # json_output is either the output dict or bytes already produced by JsonStreamEncoder;
+    # encoding is one of EXPORT_ENCODINGS
+    if encoding != 'json':
+        if isinstance(json_output, (bytes, bytearray)):
+            data, stats = encode_export(encoding, json_output)
+        else:
+            header = {key: value for key, value in json_output.items() if key != 'default'}
+            json_bytes = JsonStreamEncoder().encode(header, json_output['default']['node'], json_output['default']['node_connections'])
+            data, stats = encode_export(encoding, json_bytes, lambda: json_output)
+        with open(output_file_path, 'wb') as output_file:
+            output_file.write(data)
+        print(f"{encoding} output file '{output_file_path}' generated successfully ({stats['bytes']} bytes).")
+        return
+    with open(output_file_path, 'wb') as json_file:
+        if isinstance(json_output, (bytes, bytearray)):
+            json_file.write(json_output)
+        else:
+            header = {key: value for key, value in json_output.items() if key != 'default'}
+            JsonStreamEncoder().write(json_file, header, json_output['default']['node'], json_output['default']['node_connections'])
     print(f"JSON output file '{output_file_path}' generated successfully.")
 
 
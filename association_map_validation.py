@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+AM = 'Association Map'
+RM = 'Relationshipmap Features'
+
+MODES = ('Default', 'Upload excelfile', 'Fill from UI')
+
+# sheet -> workbook it belongs to and the dtype of every required column
+SHEET_SCHEMAS = {
+    'Node': (AM, {'Node Id': 'int', 'Name': 'string', 'Type': 'string', 'Relationship': 'string',
+                  'SubType': 'string', 'data_grid_title1': 'string', 'data_grid_info1': 'string',
+                  'data_grid_title2': 'string', 'data_grid_info2': 'string',
+                  'data_grid_title3': 'string', 'data_grid_info3': 'string',
+                  'data_grid_title4': 'string', 'data_grid_info4': 'string',
+                  'data_grid_title5': 'string', 'data_grid_info5': 'string'}),
+    'Connections': (AM, {'UId': 'string', 'from': 'int', 'to': 'int', 'Level': 'string'}),
+    'Nodes': (RM, {'Component': 'string', 'node_image': 'string', 'node_color': 'string', 'node_label_font_alignment': 'string',
+                   'node_label_font_color': 'string', 'node_label_font_background': 'string', 'node_label_font_size': 'int',
+                   'node_shape': 'string', 'node_size': 'int', 'node_shadow': 'int'}),
+    'Edge': (RM, {'L2': 'string', 'edge_width': 'int', 'edge_color': 'string', 'edge_length': 'int', 'edge_dashes': 'int',
+                  'connection_type': 'string'}),
+    'Global': (RM, {'client_name': 'string', 'logo_url': 'string', 'sidebar_short_logo': 'string', 'background_mode': 'string',
+                    'legend_Target Entity': 'string', 'legend_Organisation': 'string', 'legend_Individual': 'string',
+                    'legend_Observations': 'string'}),
+}
+
+SHEET_COLUMNS = {sheet: list(dtypes) for sheet, (workbook, dtypes) in SHEET_SCHEMAS.items()}
+
+# columns the readers load per sheet (ExcelReader's sheet_columns). Every column of the
+# Edge sheet is joined into the edge records, so it is read whole (None)
+READ_COLUMNS = dict(SHEET_COLUMNS, Edge=None)
+
+# dtypes safe to apply while reading: only text columns whose raw value never reaches the
+# generated JSON, so reading them as str cannot change the output
+READ_DTYPES = {
+    'Node': {'Relationship': str},
+    'Connections': {'UId': str, 'Level': str},
+    'Edge': {'L2': str},
+}
+
+
+# Cross-sheet rules. Each check gets the validated frames and returns the sheet the
+# violations are reported on and a boolean mask of the offending rows of that sheet.
+def subtype_in_component(frames):
+    return 'Node', ~frames['Node']['SubType'].isin(frames['Nodes']['Component'])
+
+def unique_node_id(frames):
+    return 'Node', frames['Node']['Node Id'].duplicated(keep=False)
+
+def connection_ids_exist(frames):
+    node_ids = frames['Node']['Node Id']
+    connections = frames['Connections']
+    return 'Connections', ~(connections['from'].isin(node_ids) & connections['to'].isin(node_ids))
+
+def level_in_l2(frames):
+    return 'Connections', ~frames['Connections']['Level'].isin(frames['Edge']['L2'])
+
+def single_target_entity(frames):
+    is_target = frames['Node']['SubType'].eq('Target Entity')
+    return 'Node', is_target if is_target.sum() > 1 else is_target & False
+
+def to_present(frames):
+    connections = frames['Connections']
+    return 'Connections', connections['from'].isin(frames['Node']['Node Id']) & connections['to'].isna()
+
+RULES = [
+    {'name': 'subtype_in_component', 'sheets': ('Node', 'Nodes'), 'modes': ('Fill from UI',), 'check': subtype_in_component,
+     'message': "Subtype of the node should be present in the component column in sheet Nodes"},
+    {'name': 'unique_node_id', 'sheets': ('Node',), 'modes': MODES, 'check': unique_node_id,
+     'message': "Duplicate Node IDs found in Node sheet."},
+    {'name': 'connection_ids_exist', 'sheets': ('Node', 'Connections'), 'modes': MODES, 'check': connection_ids_exist,
+     'message': "Node IDs in Connections not found in Node."},
+    {'name': 'level_in_l2', 'sheets': ('Connections', 'Edge'), 'modes': MODES, 'check': level_in_l2,
+     'message': "Level in Sample Format - Connections should be present in the L2 column of Edge - Default sheet."},
+    {'name': 'single_target_entity', 'sheets': ('Node',), 'modes': ('Fill from UI',), 'check': single_target_entity,
+     'message': "More than 1 Target Entity found in SubType column of Node."},
+    {'name': 'to_present', 'sheets': ('Node', 'Connections'), 'modes': MODES, 'check': to_present,
+     'message': "In Sample Format - Connections, missing 'To' values for some 'From' values."},
+]
+
+_compiled_rules = {}
+
+def compile_rules(mode):
+    # the rules that apply to one mode, built once and reused
+    if mode not in _compiled_rules:
+        _compiled_rules[mode] = [rule for rule in RULES if mode in rule['modes']]
+    return _compiled_rules[mode]
+
+
+def excel_rows(mask):
+    # index labels of the offending rows as the row numbers a user sees in Excel (row 1 is the header)
+    return [int(index) + 2 for index in mask[mask.to_numpy()].index]
+
+def violation(sheet, rule, message, rows=None):
+    return {'sheet': sheet, 'rule': rule, 'message': message, 'rows': rows or []}
+
+
+def check_sheet(sheet, df):
+    # required columns, blank rows and dtypes of one sheet; returns the cast frame
+    # (None when the sheet cannot be used by the cross-sheet rules) and its violations
+    workbook, dtypes = SHEET_SCHEMAS[sheet]
+    if df is None:
+        return None, [violation(sheet, 'sheet_present', f"Missing required sheet '{sheet}' in {workbook} Excel File.")]
+
+    missing = [col for col in dtypes if col not in df.columns]
+    if missing:
+        return None, [violation(sheet, 'columns_present', f"Missing columns in '{sheet}' sheet of {workbook}: {', '.join(missing)}.")]
+
+    violations = []
+    empty = (df.isnull() | df.eq('')).all(axis=1)
+    if empty.any():
+        violations.append(violation(sheet, 'no_empty_rows', f"Empty rows in '{sheet}' sheet of {workbook}.", excel_rows(empty)))
+
+    try:
+        cast = df.astype(dtypes)
+    except (ValueError, TypeError) as e:
+        cast = None
+        for col, dtype in dtypes.items():
+            rows = []
+            if dtype == 'int':
+                numbers = pd.to_numeric(df[col], errors='coerce')
+                rows = excel_rows(~np.isfinite(numbers.astype(float)))
+            if rows:
+                violations.append(violation(sheet, 'dtypes', f"Invalid datatypes in '{sheet}' sheet: column '{col}' should be {dtype}.", rows))
+        if not any(v['rule'] == 'dtypes' for v in violations):
+            violations.append(violation(sheet, 'dtypes', f"Invalid datatypes in '{sheet}' sheet: {e}"))
+
+    return cast, violations
+
+def check_rule(rule, frames):
+    sheet, mask = rule['check'](frames)
+    if mask.any():
+        return [violation(sheet, rule['name'], rule['message'], excel_rows(mask))]
+    return []
+
+
+def sheet_fingerprint(df):
+    # content hash of a parsed sheet: column names, dtypes and every cell
+    if df is None:
+        return None
+    h = hashlib.sha256()
+    h.update(repr([(str(col), str(dtype)) for col, dtype in df.dtypes.items()]).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def result_size(value):
+    # bytes held by a cached result: the cast frame of a (cast, violations) sheet result
+    # by deep memory usage, and the violations by the length of their repr
+    if isinstance(value, tuple):
+        cast, violations = value
+        size = 0 if cast is None else int(cast.memory_usage(deep=True).sum())
+    else:
+        size, violations = 0, value
+    return size + len(repr(violations))
+
+
+class ValidationCache:
+    # LRU of per-sheet results keyed by (sheet, fingerprint) and of cross-sheet rule
+    # results keyed by (rule, fingerprints of the sheets it reads), so a re-upload only
+    # re-checks the sheets that changed and the rules that touch them. Sheet results hold
+    # cast frames, so entries are evicted past maxsize or once they exceed max_bytes
+    def __init__(self, maxsize=256, max_bytes=256 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            self.misses += 1
+        value = compute()
+        size = result_size(value)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while len(self.entries) > 1 and (len(self.entries) > self.maxsize or self.total_bytes > self.max_bytes):
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted
+        return value
+
+
+class ValidationReport:
+    def __init__(self, mode):
+        self.mode = mode
+        self.frames = {}
+        self.fingerprints = {}
+        self.violations = []
+
+    def is_valid(self):
+        return not self.violations
+
+    def validated_data(self):
+        # the cast frames in the order the processors expect them
+        return tuple(self.frames[sheet] for sheet in SHEET_SCHEMAS)
+
+
+def validate_workbooks(sheets_AM, sheets_RM, mode, cache=None, deferred=()):
+    # runs every check for the mode and collects all violations instead of stopping at the first;
+    # with a ValidationCache, results for unchanged sheets and rules are reused. Sheets in
+    # deferred, and the rules reading them, are left for check_chunk
+    report = ValidationReport(mode)
+    for sheet, (workbook, dtypes) in SHEET_SCHEMAS.items():
+        if sheet in deferred:
+            continue
+        sheets = sheets_AM if workbook == AM else sheets_RM
+        df = sheets.get(sheet)
+        if cache is None:
+            cast, violations = check_sheet(sheet, df)
+        else:
+            report.fingerprints[sheet] = sheet_fingerprint(df)
+            key = ('sheet', sheet, report.fingerprints[sheet])
+            cast, violations = cache.get_or_compute(key, lambda: check_sheet(sheet, df))
+        report.violations.extend(violations)
+        if cast is not None:
+            report.frames[sheet] = cast
+
+    for rule in compile_rules(mode):
+        if all(sheet in report.frames for sheet in rule['sheets']) and not set(rule['sheets']) & set(deferred):
+            if cache is None:
+                violations = check_rule(rule, report.frames)
+            else:
+                key = ('rule', rule['name']) + tuple(report.fingerprints[sheet] for sheet in rule['sheets'])
+                violations = cache.get_or_compute(key, lambda: check_rule(rule, report.frames))
+            report.violations.extend(violations)
+    return report
+
+
+def check_chunk(sheet, chunk, frames, mode):
+    # check_sheet and the cross-sheet rules reading the sheet, for one chunk of a sheet read
+    # in pieces; frames holds the other sheets, already cast. Returns the cast chunk (None
+    # when it fails the sheet checks) and its violations
+    cast, violations = check_sheet(sheet, chunk)
+    if cast is not None:
+        frames = dict(frames, **{sheet: cast})
+        for rule in compile_rules(mode):
+            if sheet in rule['sheets'] and all(name in frames for name in rule['sheets']):
+                violations.extend(check_rule(rule, frames))
+    return cast, violations
+
+def merge_violations(violations):
+    # one violation per sheet, rule and message with the rows of every chunk it was found in
+    merged = {}
+    for v in violations:
+        key = (v['sheet'], v['rule'], v['message'])
+        if key in merged:
+            merged[key]['rows'].extend(v['rows'])
+        else:
+            merged[key] = dict(v, rows=list(v['rows']))
+    return list(merged.values())
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Writes a valid Association Map workbook and a matching Relationshipmap Features workbook
+# of any size, for benchmarks.
+#
+#   python benchmarks/generate_maps.py --nodes 50000 --connections 100000 --subtypes 20 --out bench_data/
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+IMAGE_URL = 'https://association-map-cdn-public.s3.us-west-1.amazonaws.com/DragnetAlpha/AssociationMap/Stories2.png'
+
+
+def make_features(subtypes=10, levels=3):
+    components = ['Target Entity'] + [f'SubType {i}' for i in range(1, subtypes)]
+    nodes = pd.DataFrame({
+        'Component': components,
+        'node_image': IMAGE_URL,
+        'node_color': 'grey',
+        'node_label_font_alignment': 'center',
+        'node_label_font_color': 'grey',
+        'node_label_font_background': 'White',
+        'node_label_font_size': 10,
+        'node_shape': 'image',
+        'node_size': 12,
+        'node_shadow': [i % 2 for i in range(subtypes)],
+    })
+    edge = pd.DataFrame({
+        'L2': [f'Level {i}' for i in range(1, levels + 1)],
+        'edge_width': 1,
+        'edge_color': 'black',
+        'edge_length': [250 + 50 * i for i in range(levels)],
+        'edge_dashes': [i % 2 for i in range(levels)],
+        'connection_type': 'Close Connection',
+    })
+    global_df = pd.DataFrame({
+        'client_name': ['Benchmark'],
+        'logo_url': [IMAGE_URL],
+        'sidebar_short_logo': [IMAGE_URL],
+        'background_mode': [json.dumps(['Default', 'Light', 'Dark'])],
+        'legend_Target Entity': [IMAGE_URL],
+        'legend_Organisation': [IMAGE_URL],
+        'legend_Individual': [IMAGE_URL],
+        'legend_Observations': [IMAGE_URL],
+    })
+    return {'Nodes': nodes, 'Edge': edge, 'Global': global_df}
+
+
+def make_map(features, nodes=1000, connections=2000, seed=0):
+    # one Target Entity, every other SubType drawn from the template, from/to drawn from
+    # existing Node Ids and Level from the template's L2 values
+    rng = np.random.default_rng(seed)
+    components = features['Nodes']['Component'].to_numpy()
+    node_ids = np.arange(1, nodes + 1)
+    subtypes = rng.choice(components[1:], nodes) if len(components) > 1 else np.repeat(components[:1], nodes)
+    subtypes = subtypes.astype(object)
+    subtypes[0] = 'Target Entity'
+    node = pd.DataFrame({
+        'Node Id': node_ids,
+        'Name': [f'Node "{i}"' for i in node_ids],
+        'Type': rng.choice(['Organisation', 'Individual', 'Observations'], nodes),
+        'Relationship': 'Associated',
+        'SubType': subtypes,
+    })
+    for i in range(1, 6):
+        blank = rng.random(nodes) < 0.3
+        node[f'data_grid_title{i}'] = np.where(blank, None, f'Title {i}')
+        node[f'data_grid_info{i}'] = np.where(blank, None, [f'Info {i}.{n}' for n in range(nodes)])
+    connection = pd.DataFrame({
+        'UId': [f'C{i}' for i in range(1, connections + 1)],
+        'from': rng.choice(node_ids, connections),
+        'to': rng.choice(node_ids, connections),
+        'Level': rng.choice(features['Edge']['L2'].to_numpy(), connections),
+    })
+    return {'Node': node, 'Connections': connection}
+
+
+def write_workbook(path, sheets):
+    with pd.ExcelWriter(path) as writer:
+        for name, df in sheets.items():
+            df.to_excel(writer, sheet_name=name, index=False)
+
+
+def generate_workbooks(out_dir, nodes=1000, connections=2000, subtypes=10, levels=3, seed=0):
+    # returns the paths of the Association Map and Relationshipmap Features workbooks
+    os.makedirs(out_dir, exist_ok=True)
+    features = make_features(subtypes, levels)
+    path_AM = os.path.join(out_dir, f'association_map_{nodes}x{connections}_{subtypes}x{levels}_s{seed}.xlsx')
+    path_RM = os.path.join(out_dir, f'relationshipmap_features_{subtypes}x{levels}.xlsx')
+    if not os.path.exists(path_RM):
+        write_workbook(path_RM, features)
+    if not os.path.exists(path_AM):
+        write_workbook(path_AM, make_map(features, nodes, connections, seed))
+    return path_AM, path_RM
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic Association Map workbooks.")
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--subtypes', type=int, default=10)
+    parser.add_argument('--levels', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='bench_data')
+    args = parser.parse_args(argv)
+    for path in generate_workbooks(args.out, args.nodes, args.connections, args.subtypes, args.levels, args.seed):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
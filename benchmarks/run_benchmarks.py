@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Times each stage of the Excel-to-JSON pipeline on synthetic maps and saves the results
+# as JSON so runs can be compared.
+#
+#   python benchmarks/run_benchmarks.py --sizes 1000x2000 10000x20000 --output bench_results.json
+#   python benchmarks/run_benchmarks.py --sizes 10000x20000 --compare bench_results.json
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+from association_map_db import JsonStore
+from association_map_utils import (SHAPE_IMAGES, ConnectionProcessor, ExcelReader, GlobalProcessor, GlobalProcessor1,
+                                   JsonGenerator, JsonStreamEncoder, NodeProcessor, NodeProcessor1, WorkbookBundle, encode_v2)
+from association_map_validation import READ_COLUMNS, READ_DTYPES, validate_workbooks
+from generate_maps import generate_workbooks
+
+
+def timed(fn):
+    start = time.perf_counter()
+    value = fn()
+    return time.perf_counter() - start, value
+
+
+def run_once(path_AM, path_RM, db_path):
+    # one pass over every stage; returns {stage: seconds}
+    timings = {}
+    data_AM = WorkbookBundle.read_bytes(path_AM)
+    data_RM = WorkbookBundle.read_bytes(path_RM)
+    # parse -> parse_engine is the fastest installed engine alone, parse_engine ->
+    # parse_projected the column projection and dtypes on that same engine
+    timings['parse'], bundle_AM = timed(lambda: WorkbookBundle.from_bytes(data_AM))
+    timings['parse_engine'], _ = timed(lambda: WorkbookBundle.from_bytes(data_AM, reader=ExcelReader()))
+    reader = ExcelReader(sheet_columns=READ_COLUMNS, dtypes=READ_DTYPES)
+    timings['parse_projected'], _ = timed(lambda: WorkbookBundle.from_bytes(data_AM, reader=reader))
+    bundle_RM = WorkbookBundle.from_bytes(data_RM)
+
+    # validate_excel1 covers 'Default'/'Upload excelfile', validate_excel covers 'Fill from UI'
+    timings['validate_excel1'], _ = timed(lambda: validate_workbooks(bundle_AM.sheets, bundle_RM.sheets, 'Default'))
+    timings['validate_excel'], _ = timed(lambda: validate_workbooks(bundle_AM.sheets, bundle_RM.sheets, 'Fill from UI'))
+
+    node_df = bundle_AM['Node']
+    connection_df = bundle_AM['Connections']
+    map_feature = bundle_RM.sheets
+    distinct_values = node_df['SubType'].unique().tolist()
+    d = {subtype: 'Blue Hexagon' for subtype in distinct_values}
+
+    timings['node_processor1'], nodes = timed(lambda: NodeProcessor1(node_df, map_feature, connection_df)
+                                              .process_node_data(node_df, map_feature, connection_df))
+    timings['node_processor'], _ = timed(lambda: NodeProcessor(node_df, map_feature, connection_df, d, SHAPE_IMAGES)
+                                         .process_node_data(node_df, map_feature, connection_df, d, SHAPE_IMAGES))
+    timings['connection_processor'], connections = timed(lambda: ConnectionProcessor(node_df, map_feature, connection_df)
+                                                         .process_connection_data())
+    timings['global_processor1'], legend_data = timed(lambda: GlobalProcessor1.process_global_data(map_feature['Nodes'], distinct_values))
+    timings['global_processor'], _ = timed(lambda: GlobalProcessor.process_global_data(SHAPE_IMAGES, distinct_values, d))
+
+    global_df = map_feature['Global']
+    client_name, logo_url, sidebar_short_logo = (global_df[col].values[0] for col in ('client_name', 'logo_url', 'sidebar_short_logo'))
+    generator = JsonGenerator(legend_data, client_name, logo_url, sidebar_short_logo, nodes, connections,
+                              map_feature['Nodes'], global_df, map_feature, node_df)
+    header = generator.create_json_header(legend_data, client_name, logo_url, sidebar_short_logo, global_df, node_df)
+    timings['json_encode'], json_bytes = timed(lambda: JsonStreamEncoder().encode(header, nodes, connections))
+    timings['json_encode_compact'], _ = timed(lambda: JsonStreamEncoder(compact=True, backend='auto').encode(header, nodes, connections))
+    timings['json_encode_v2'], _ = timed(lambda: encode_v2(JsonStreamEncoder(compact=True, backend='auto'), header, nodes, connections))
+
+    store = JsonStore.sqlite(db_path)
+    timings['db_insert'], _ = timed(lambda: store.insert(json_bytes.decode('utf-8'), 'benchmark'))
+    timings['db_save'], _ = timed(lambda: store.save(json_bytes, 'benchmark'))
+    store.close()
+    return timings, len(json_bytes)
+
+
+def run_size(nodes, connections, subtypes, levels, repeats, data_dir):
+    path_AM, path_RM = generate_workbooks(data_dir, nodes, connections, subtypes, levels)
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(repeats):
+            timings, output_bytes = run_once(path_AM, path_RM, os.path.join(tmp, f'bench{i}.db'))
+            runs.append(timings)
+    stages = {stage: {'min': min(run[stage] for run in runs), 'median': statistics.median(run[stage] for run in runs)}
+              for stage in runs[0]}
+    return {'nodes': nodes, 'connections': connections, 'subtypes': subtypes, 'levels': levels,
+            'repeats': repeats, 'output_bytes': output_bytes, 'stages': stages}
+
+
+def compare(results, baseline, threshold, min_delta=0.005):
+    # stages whose min time grew by more than threshold x against the same size in baseline;
+    # growth under min_delta seconds is timer noise on the fast stages and is not reported
+    previous = {(r['nodes'], r['connections']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get((result['nodes'], result['connections']))
+        if old is None:
+            continue
+        for stage, times in result['stages'].items():
+            if stage not in old['stages']:
+                continue
+            before = old['stages'][stage]['min']
+            if times['min'] - before >= min_delta and times['min'] > before * threshold:
+                regressions.append((result['nodes'], result['connections'], stage, before, times['min']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the Excel-to-JSON pipeline.")
+    parser.add_argument('--sizes', nargs='+', default=['1000x2000', '10000x20000'], help="NODESxCONNECTIONS")
+    parser.add_argument('--subtypes', type=int, default=10)
+    parser.add_argument('--levels', type=int, default=3)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--data-dir', default='bench_data')
+    parser.add_argument('--output', help="save the results to this JSON file")
+    parser.add_argument('--compare', help="results JSON from an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=1.25, help="slowdown factor reported as a regression")
+    parser.add_argument('--min-delta-ms', type=float, default=5, help="slowdowns smaller than this are never reported")
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in args.sizes:
+        nodes, connections = (int(n) for n in size.lower().split('x'))
+        result = run_size(nodes, connections, args.subtypes, args.levels, args.repeats, args.data_dir)
+        results.append(result)
+        print(f"{nodes} nodes x {connections} connections ({result['output_bytes']} bytes of JSON)")
+        for stage, times in result['stages'].items():
+            print(f"  {stage:<22} min {times['min']:.4f}s  median {times['median']:.4f}s")
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold, args.min_delta_ms / 1000)
+        for nodes, connections, stage, old, new in regressions:
+            print(f"REGRESSION {nodes}x{connections} {stage}: {old:.4f}s -> {new:.4f}s")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Measures what a new replica pays before the login form appears: importing the app
+# module in a fresh interpreter, and loading the template workbooks cold, warm (mtime
+# unchanged) and after the file changes on disk.
+#
+#   python benchmarks/startup_benchmark.py --repeats 5 --output startup.json
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import openpyxl
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from association_map_utils import WorkbookCache
+
+TEMPLATES = ('Project names.xlsx', 'Relationshipmap Features Template.xlsx')
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import association_map_main
+print(time.perf_counter() - start)
+"""
+
+
+def measure_import(module_script=IMPORT_SCRIPT):
+    # seconds to import the app in a new interpreter, and the wall time of the whole process
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-c', module_script], cwd=ROOT, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+    return float(completed.stdout.strip().splitlines()[-1]), elapsed
+
+
+def edit_workbook(path):
+    # saves the workbook again with its last row repeated on the first sheet, so a reload
+    # has new content to hash and parse as after a real template edit
+    workbook = openpyxl.load_workbook(path)
+    sheet = workbook.worksheets[0]
+    sheet.append([cell.value for cell in sheet[sheet.max_row]])
+    workbook.save(path)
+
+
+def measure_templates(tmp):
+    # cold load, warm load and hot reload of each template through one WorkbookCache
+    timings = {}
+    cache = WorkbookCache(maxsize=len(TEMPLATES))
+    for name in TEMPLATES:
+        path = os.path.join(tmp, name)
+        shutil.copyfile(os.path.join(ROOT, name), path)
+        start = time.perf_counter()
+        cache.get(path)
+        timings[f'{name} cold'] = time.perf_counter() - start
+        start = time.perf_counter()
+        cache.get(path)
+        timings[f'{name} warm'] = time.perf_counter() - start
+        edit_workbook(path)
+        start = time.perf_counter()
+        cache.get(path)
+        timings[f'{name} reload'] = time.perf_counter() - start
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app's startup and template loading.")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--skip-import', action='store_true', help="only time the template loads")
+    parser.add_argument('--output', help="save the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for i in range(args.repeats):
+        timings = {}
+        if not args.skip_import:
+            timings['import'], timings['process'] = measure_import()
+        with tempfile.TemporaryDirectory() as tmp:
+            timings.update(measure_templates(tmp))
+        runs.append(timings)
+
+    stages = {stage: {'min': min(run[stage] for run in runs), 'median': statistics.median(run[stage] for run in runs)}
+              for stage in runs[0]}
+    for stage, times in stages.items():
+        print(f"  {stage:<52} min {times['min']:.4f}s  median {times['median']:.4f}s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                       'machine': platform.machine(), 'repeats': args.repeats, 'stages': stages}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())